@@ -0,0 +1,123 @@
+import json
+import os
+import re
+import sys
+from argparse import ArgumentParser
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from model.context_builder import ContextBuilder, token_counter, file_prefix, file_postfix, numbered_line, \
+    CONTEXT_CANDIDATES
+from task.run_task import LLMCodeGenerator, HOME
+
+HUNK_PATTERN = re.compile(r'^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@')
+
+
+def read_task_instances(file_path):
+    with open(file_path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def gold_lines(patch, project_path):
+    # file path -> zero based lines of the original file that the patch removes or inserts at
+    lines = {}
+    file_name = None
+    old_line = 0
+    for line in patch.splitlines():
+        if line.startswith('--- '):
+            path = line[4:].strip()
+            file_name = os.path.join(project_path, path[2:]) if path.startswith('a/') else None
+        elif line.startswith('+++ '):
+            continue
+        elif line.startswith('@@'):
+            match = HUNK_PATTERN.match(line)
+            old_line = int(match.group(1)) - 1 if match else 0
+        elif file_name is None:
+            continue
+        elif line.startswith('-'):
+            lines.setdefault(file_name, set()).add(old_line)
+            old_line += 1
+        elif line.startswith('+'):
+            lines.setdefault(file_name, set()).add(old_line)
+        elif line.startswith(' '):
+            old_line += 1
+    return lines
+
+
+def coverage(gold, selected):
+    # share of gold lines present in the context
+    total = sum(len(lines) for lines in gold.values())
+    if not total:
+        return 0.0
+    return sum(len(lines & selected.get(file_name, set())) for file_name, lines in gold.items()) / total
+
+
+def whole_file_context(file_names, read_lines):
+    # the context generate_patch used to send: every line of the files of the top snippets
+    selected, code_with_location = {}, ''
+    for file_name in file_names:
+        lines = read_lines(file_name)
+        selected[file_name] = set(range(len(lines)))
+        code_with_location += file_prefix(file_name) + ''.join(
+            numbered_line(idx, line) for idx, line in enumerate(lines)) + file_postfix(file_name)
+    return code_with_location, selected
+
+
+def main(task_file, project_path, language, model_name, token_budgets, candidates, baseline_k, limit):
+    from model.vector_store import VectorStore
+
+    tasks = read_task_instances(task_file)[:limit]
+    count_tokens = token_counter(model_name)
+    results = {'whole_files': []}
+    results.update({budget: [] for budget in token_budgets})
+    for task in tasks:
+        project_name = task['repo'].split('/')[1]
+        generator = LLMCodeGenerator(language=language, project_name=project_name, project_path=project_path,
+                                     user_instruction=task['problem_statement'], sha=task['base_commit'],
+                                     model_name=model_name)
+        # only snapshots indexed before are used, the benchmark makes no summary requests
+        vector_store = VectorStore(generator.embeddings_model, project_name, generator.sha)
+        if vector_store.load_db() != 1:
+            print(f"Skip {project_name} {task['base_commit']}: no vector store for this commit.")
+            continue
+        matched_docs = vector_store.match_documents(task['problem_statement'], k=max(candidates, baseline_k))
+        gold = gold_lines(task['patch'], generator.project_path)
+
+        builder = ContextBuilder(language, model_name, token_budget=None, count_tokens=count_tokens)
+        baseline_files = list(dict.fromkeys(doc.metadata['file_name'] for doc in matched_docs[:baseline_k]))
+        code_with_location, selected = whole_file_context(baseline_files, builder.read_lines)
+        results['whole_files'].append((count_tokens(code_with_location), coverage(gold, selected)))
+        for budget in token_budgets:
+            builder.token_budget = budget
+            _, tokens = builder.build(matched_docs[:candidates])
+            results[budget].append((tokens, coverage(gold, builder.selected)))
+
+    print(f"{len(results['whole_files'])} tasks, share of gold patch lines in the context")
+    columns = ["context", "tokens_mean", "tokens_p50", "tokens_p95", "coverage"]
+    print(' '.join(f'{column:>13}' for column in columns))
+    for name, rows in results.items():
+        if not rows:
+            continue
+        tokens = np.array([row[0] for row in rows])
+        print(f'{str(name):>13} {tokens.mean():>13.0f} {np.percentile(tokens, 50):>13.0f} '
+              f'{np.percentile(tokens, 95):>13.0f} {np.mean([row[1] for row in rows]):>13.3f}')
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--task_file", type=str, required=True, help="Task instances jsonl with gold patches.")
+    parser.add_argument("--project_path", type=str, default=HOME, help="Directory the repositories are cloned in.")
+    parser.add_argument("--language", type=str, default="flutter", choices=["flutter", "python"])
+    parser.add_argument("--model_name", type=str, default="gpt-4o-mini", help="Model whose tokenizer counts tokens.")
+    parser.add_argument("--token_budgets", type=int, nargs='+', default=[4000, 8000, 12000],
+                        help="Context token budgets to compare.")
+    parser.add_argument("--candidates", type=int, default=CONTEXT_CANDIDATES,
+                        help="Retrieved snippets offered to the context builder.")
+    parser.add_argument("--baseline_k", type=int, default=4,
+                        help="Retrieved snippets whose whole files make up the baseline context.")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of tasks.")
+    args = parser.parse_args()
+    main(**vars(args))
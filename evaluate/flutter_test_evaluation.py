@@ -4,7 +4,7 @@ import json
 import datetime
 
 from evaluate.flutter_test_analysis import compare_test_result
-from task.run_task import LLMCodeGenerator
+from task.run_task import LLMCodeGenerator, CommitIndexer
 from flutter_version_manage import manage_flutter_version
 
 HOME = os.getenv('HOME')
@@ -220,7 +220,7 @@ def test_gold_patch():
                 print("Validation error:")
                 print(e)
 
-def generate_model_patch(repo, log_dir, model_name="gpt-4o-mini"):
+def generate_model_patch(repo, log_dir, model_name="gpt-4o-mini", index_workers=1):
     if not os.path.exists(os.path.join(MODEL_PATCHES, log_dir)):
         # create dir
         os.makedirs(os.path.join(MODEL_PATCHES, log_dir))
@@ -235,54 +235,59 @@ def generate_model_patch(repo, log_dir, model_name="gpt-4o-mini"):
         passed = compare_test_result(project_name)
         if repo_name == project_name:
             task_instances = read_task_instances(file)
-            last_commit = None
-            for task_instance in task_instances[:]:
-                # create model patch
-                start_time = datetime.datetime.now()
-                model_patch = ''
-                project_name = task_instance['repo'].split('/')[1]
-                base_commit = task_instance['base_commit']
-
-                print(passed)
-                if base_commit not in passed:
-                    continue
-                print(project_name, base_commit, datetime.datetime.now())
-                user_instruction = task_instance['problem_statement']
-                print(user_instruction)
-                generator = LLMCodeGenerator(language='flutter', project_name=project_name, project_path=HOME,
-                                             user_instruction=user_instruction, sha=base_commit, model_name=model_name)
-                try:
-                    refresh = True if not last_commit else False
-                    generator.set_vector_store(refresh=False, update_from_sha=last_commit)
-                    matched_docs, all_success, all_message = generator.generate_patch()
-                    print(all_success)
-                    model_patch = generator.create_git_diff()
-                    print(model_patch)
-                    token_usage = generator.llm.token_usage
-                    end_time = datetime.datetime.now()
-                    task_instance["token_usage"] = token_usage
-                    task_instance["model_patch"] = model_patch
-                    task_instance["model_name"] = model_name
-                    task_instance["run_time"] = (end_time - start_time).total_seconds()
-                    task_instance["matched_docs"] = str(matched_docs)
-                    task_instance["log_message"] = all_message
-                    task_instance["success"] = all_success
-                    task_instance["llm_instruction"] = generator.user_instruction
-                except Exception as e:
-                    print("ERROR:", e)
-
-                generator.restore_git_files()
-                last_commit = base_commit
-                # save model patch
-                with open(os.path.join(MODEL_PATCHES, log_dir, f'{project_name}_{base_commit}_model_patch.diff'),'w', encoding='utf-8') as f:
-                    f.write(model_patch)
-                print('Model diff patch saved', datetime.datetime.now())
-                #save log
-                if not os.path.exists(os.path.join(LOGS, log_dir)):
-                    os.mkdir(os.path.join(LOGS, log_dir))
-                with open(os.path.join(LOGS, log_dir, f'{project_name}_{base_commit}_log.json'),'w', encoding='utf-8') as f:
-                    json.dump(task_instance, f)
-                print('Model log saved', datetime.datetime.now())
+            # upcoming base commits are indexed in the background while the patch of the current one is generated
+            base_commits = [task_instance['base_commit'] for task_instance in task_instances
+                            if task_instance['base_commit'] in passed]
+            with CommitIndexer('flutter', repo_name, HOME, base_commits, workers=index_workers,
+                               model_name=model_name) as indexer:
+                for task_instance in task_instances[:]:
+                    # create model patch
+                    start_time = datetime.datetime.now()
+                    model_patch = ''
+                    project_name = task_instance['repo'].split('/')[1]
+                    base_commit = task_instance['base_commit']
+
+                    print(passed)
+                    if base_commit not in passed:
+                        continue
+                    print(project_name, base_commit, datetime.datetime.now())
+                    user_instruction = task_instance['problem_statement']
+                    print(user_instruction)
+                    indexer.wait(base_commit)
+                    generator = LLMCodeGenerator(language='flutter', project_name=project_name, project_path=HOME,
+                                                 user_instruction=user_instruction, sha=base_commit, model_name=model_name)
+                    try:
+                        # loads the snapshot built in the background, or updates the indexed commit closest to
+                        # base_commit when that failed
+                        generator.set_vector_store(refresh=False)
+                        matched_docs, all_success, all_message = generator.generate_patch()
+                        print(all_success)
+                        model_patch = generator.create_git_diff()
+                        print(model_patch)
+                        token_usage = generator.llm.token_usage
+                        end_time = datetime.datetime.now()
+                        task_instance["token_usage"] = token_usage
+                        task_instance["model_patch"] = model_patch
+                        task_instance["model_name"] = model_name
+                        task_instance["run_time"] = (end_time - start_time).total_seconds()
+                        task_instance["matched_docs"] = str(matched_docs)
+                        task_instance["log_message"] = all_message
+                        task_instance["success"] = all_success
+                        task_instance["llm_instruction"] = generator.user_instruction
+                    except Exception as e:
+                        print("ERROR:", e)
+
+                    generator.restore_git_files()
+                    # save model patch
+                    with open(os.path.join(MODEL_PATCHES, log_dir, f'{project_name}_{base_commit}_model_patch.diff'),'w', encoding='utf-8') as f:
+                        f.write(model_patch)
+                    print('Model diff patch saved', datetime.datetime.now())
+                    #save log
+                    if not os.path.exists(os.path.join(LOGS, log_dir)):
+                        os.mkdir(os.path.join(LOGS, log_dir))
+                    with open(os.path.join(LOGS, log_dir, f'{project_name}_{base_commit}_log.json'),'w', encoding='utf-8') as f:
+                        json.dump(task_instance, f)
+                    print('Model log saved', datetime.datetime.now())
 
 
 def test_model_patch(log_dir="gpt4omini"):
@@ -0,0 +1,138 @@
+import json
+import os
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from evaluate.context_benchmark import read_task_instances, gold_lines
+from model import cache, vector_store
+from model.embeddings import CachedEmbeddings
+from model.vector_store import manifest_path, segment_dir, dir_size, HYBRID_CANDIDATES, TOP_FILES
+from task.run_task import LLMCodeGenerator, HOME, SUFFIX, EMBEDDING_MODEL, create_embeddings_model
+
+# retrieval mode -> (hybrid, top_files) passed to match_documents
+RETRIEVAL_MODES = {"vector": (False, None),
+                   "hybrid": (True, None),
+                   "two_stage": (False, TOP_FILES),
+                   "hybrid_two_stage": (True, TOP_FILES)}
+
+
+def gold_files(patch, project_path, language):
+    # code files the gold patch changes, files it adds can not be retrieved
+    return {file_name for file_name in gold_lines(patch, project_path) if file_name.endswith(SUFFIX[language])}
+
+
+def ranked_files(docs):
+    return list(dict.fromkeys(doc.metadata['file_name'] for doc in docs))
+
+
+def recall_at_k(files, gold, k):
+    return len(set(files[:k]) & gold) / len(gold)
+
+
+def reciprocal_rank(files, gold):
+    for rank, file_name in enumerate(files, start=1):
+        if file_name in gold:
+            return 1 / rank
+    return 0.0
+
+
+def snapshot_size(project_name, sha):
+    with open(manifest_path(project_name, sha), 'r') as f:
+        segment_ids = json.load(f)["segments"]
+    return sum(dir_size(segment_dir(project_name, segment_id)) for segment_id in segment_ids)
+
+
+def main(task_file, project_path, language, model_name, contents, index_types, compression, modes, ks,
+         num_snippets, limit, cache_dir):
+    tasks = read_task_instances(task_file)[:limit]
+    configs = [(content, index_type) for content in contents for index_type in index_types]
+    # every config has its own snippet, summary and embedding caches and its own snapshots, so no config builds
+    # on the work of another and build times compare
+    cache_dir = cache_dir or tempfile.mkdtemp(prefix='retrieval_benchmark_')
+    cache_dirs = {config: os.path.join(cache_dir, '-'.join(config)) for config in configs}
+    vector_store.VECTORSTORE = os.path.join(cache_dir, 'vectorstore')
+    embeddings = {}
+    print(f"Caches and snapshots of the configs in {cache_dir}")
+    # per config: sha of the last indexed task, build times and sizes, and per mode the query results
+    last_commits = {config: None for config in configs}
+    builds = {config: [] for config in configs}
+    sizes = {config: 0 for config in configs}
+    queries = {(config, mode): [] for config in configs for mode in modes}
+    for task in tasks:
+        project_name = task['repo'].split('/')[1]
+        # one checkout per task, every config indexes the same tree
+        generator = LLMCodeGenerator(language=language, project_name=project_name, project_path=project_path,
+                                     user_instruction=task['problem_statement'], sha=task['base_commit'],
+                                     model_name=model_name)
+        gold = gold_files(task['patch'], generator.project_path, language)
+        if not gold:
+            print(f"Skip {project_name} {task['base_commit']}: the gold patch changes no existing code file.")
+            continue
+        for config in configs:
+            content, index_type = config
+            store_name = f'{project_name}-{content}-{index_type}-{compression}'
+            cache.CACHE_DIR = cache_dirs[config]
+            if config not in embeddings:
+                embeddings[config] = CachedEmbeddings(create_embeddings_model, model_name=EMBEDDING_MODEL)
+            generator.embeddings_model = embeddings[config]
+            start = time.perf_counter()
+            generator.set_vector_store(update_from_sha=last_commits[config], index_type=index_type,
+                                       compression=compression, content=content, store_name=store_name)
+            builds[config].append(time.perf_counter() - start)
+            sizes[config] = snapshot_size(store_name, generator.sha)
+            last_commits[config] = generator.sha
+            # the query embedding is cached by the first call, so every mode is timed warm
+            generator.embeddings_model.embed_query(task['problem_statement'])
+            for mode in modes:
+                hybrid, top_files = RETRIEVAL_MODES[mode]
+                start = time.perf_counter()
+                docs = generator.vector_store.match_documents(task['problem_statement'], k=num_snippets,
+                                                              hybrid=hybrid, top_files=top_files)
+                latency = time.perf_counter() - start
+                queries[(config, mode)].append((ranked_files(docs), gold, latency))
+        generator.restore_git_files()
+
+    print(f"{len(tasks)} tasks, recall of gold patch files among the files of {num_snippets} retrieved snippets")
+    columns = ["content", "index_type", "mode"] + [f"recall@{k}" for k in ks] + \
+        ["mrr", "query_p50_ms", "query_p95_ms", "build_s", "size_mb"]
+    print(' '.join(f'{column:>16}' for column in columns))
+    for (config, mode), rows in queries.items():
+        if not rows:
+            continue
+        latencies = [row[2] * 1000 for row in rows]
+        values = list(config) + [mode] + [np.mean([recall_at_k(files, gold, k) for files, gold, _ in rows])
+                                          for k in ks]
+        values += [np.mean([reciprocal_rank(files, gold) for files, gold, _ in rows]),
+                   np.percentile(latencies, 50), np.percentile(latencies, 95), sum(builds[config]),
+                   sizes[config] / 1024 / 1024]
+        print(' '.join(f'{value:>16.3f}' if isinstance(value, float) else f'{value:>16}' for value in values))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--task_file", type=str, required=True, help="Task instances jsonl with gold patches.")
+    parser.add_argument("--project_path", type=str, default=HOME, help="Directory the repositories are cloned in.")
+    parser.add_argument("--language", type=str, default="flutter", choices=["flutter", "python"])
+    parser.add_argument("--model_name", type=str, default="gpt-4o-mini", help="Model name of the summaries.")
+    parser.add_argument("--contents", type=str, nargs='+', default=['summary', 'code'],
+                        choices=['summary', 'code'], help="Snippet contents to embed.")
+    parser.add_argument("--index_types", type=str, nargs='+', default=['flat'], help="Vector index types to compare.")
+    parser.add_argument("--compression", type=str, default='none', help="Encoding of stored vectors.")
+    parser.add_argument("--modes", type=str, nargs='+', default=list(RETRIEVAL_MODES),
+                        choices=list(RETRIEVAL_MODES), help="Retrieval modes to compare.")
+    parser.add_argument("--ks", type=int, nargs='+', default=[1, 3, 5], help="Cutoffs of file recall.")
+    parser.add_argument("--num_snippets", type=int, default=HYBRID_CANDIDATES, help="Snippets retrieved per query.")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of tasks.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Directory of the per config caches and snapshots, reused by later runs which then "
+                             "measure warm builds. Use a new temporary directory as default, so every config "
+                             "starts cold and requests its own summaries.")
+    args = parser.parse_args()
+    main(**vars(args))
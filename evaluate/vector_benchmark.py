@@ -0,0 +1,127 @@
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+from argparse import ArgumentParser
+
+import faiss
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT)
+
+from model.cache import EMBEDDING_CACHE, cache_path
+from model.index_factory import build_index, normalize, reconstruct_vectors, read_index, select_compression, \
+    COMPRESSIONS
+from model.vector_store import manifest_path, segment_dir
+
+
+def load_vectors(project_name=None, sha=None, embedding_cache=cache_path(EMBEDDING_CACHE), limit=None):
+    if project_name and sha:
+        with open(manifest_path(project_name, sha), 'r') as f:
+            segment_ids = json.load(f)["segments"]
+        vectors = np.concatenate([
+            reconstruct_vectors(faiss.read_index(os.path.join(segment_dir(project_name, segment_id), 'index.faiss')))
+            for segment_id in segment_ids])
+    else:
+        conn = sqlite3.connect(embedding_cache)
+        query = "SELECT vector FROM embeddings" + (f" LIMIT {int(limit)}" if limit else "")
+        vectors = np.stack([np.frombuffer(row[0], dtype=np.float32) for row in conn.execute(query)])
+        conn.close()
+    if limit:
+        vectors = vectors[:limit]
+    return normalize(vectors)
+
+
+def resident_bytes():
+    # resident set size of this process, 0 where /proc is not available
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+def recall_at_k(exact_ids, approx_ids, k):
+    hits = 0
+    for exact, approx in zip(exact_ids, approx_ids):
+        hits += len(set(exact[:k]) & set(approx[:k]))
+    return hits / (len(exact_ids) * k)
+
+
+def benchmark_index(base, queries, exact_ids, index_type, compression, k):
+    compression = select_compression(len(base), compression)
+    start = time.perf_counter()
+    index = build_index(base, base.shape[1], index_type, compression)
+    build_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'index.faiss')
+        faiss.write_index(index, path)
+        size = os.path.getsize(path)
+        # loaded the way a saved segment is, the memory it takes shows which indexes are actually memory mapped
+        rss = resident_bytes()
+        start = time.perf_counter()
+        loaded = read_index(path, index_type)
+        load_time = time.perf_counter() - start
+        load_rss = max(0, resident_bytes() - rss)
+
+        latencies = []
+        approx_ids = []
+        for query in queries:
+            start = time.perf_counter()
+            _, ids = loaded.search(query.reshape(1, -1), k)
+            latencies.append(time.perf_counter() - start)
+            approx_ids.append(ids[0])
+        del loaded
+    return {"index_type": index_type,
+            "compression": compression,
+            "recall": recall_at_k(exact_ids, approx_ids, k),
+            "size_mb": size / 1024 / 1024,
+            "load_rss_mb": load_rss / 1024 / 1024,
+            "build_s": build_time,
+            "load_ms": load_time * 1000,
+            "query_p50_ms": float(np.percentile(latencies, 50)) * 1000,
+            "query_p95_ms": float(np.percentile(latencies, 95)) * 1000}
+
+
+def main(project_name, sha, embedding_cache, limit, num_queries, k, index_types, compressions):
+    vectors = load_vectors(project_name, sha, embedding_cache, limit)
+    # held out vectors act as queries, ground truth comes from an exact search
+    rng = np.random.default_rng(0)
+    rng.shuffle(vectors)
+    num_queries = min(num_queries, len(vectors) // 10 or 1)
+    queries, base = vectors[:num_queries], vectors[num_queries:]
+    exact = build_index(base, base.shape[1], 'flat')
+    _, exact_ids = exact.search(queries, k)
+    print(f"{len(base)} vectors of dimension {base.shape[1]}, {len(queries)} queries, recall@{k}")
+
+    columns = ["index_type", "compression", "recall", "size_mb", "load_rss_mb", "build_s", "load_ms",
+               "query_p50_ms", "query_p95_ms"]
+    print(' '.join(f'{column:>13}' for column in columns))
+    for index_type in index_types:
+        for compression in compressions:
+            result = benchmark_index(base, queries, exact_ids, index_type, compression, k)
+            print(' '.join(f'{result[column]:>13.3f}' if isinstance(result[column], float)
+                           else f'{result[column]:>13}' for column in columns))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--project_name", type=str, default=None,
+                        help="Project of the saved vector store to read vectors from. "
+                             "Use the embedding cache as default.")
+    parser.add_argument("--sha", type=str, default=None, help="Commit sha of the saved vector store.")
+    parser.add_argument("--embedding_cache", type=str, default=cache_path(EMBEDDING_CACHE),
+                        help="Path to the embedding cache.")
+    parser.add_argument("--limit", type=int, default=None, help="Maximum number of vectors to use.")
+    parser.add_argument("--num_queries", type=int, default=200, help="Number of held out query vectors.")
+    parser.add_argument("--k", type=int, default=4, help="Number of neighbours compared for recall.")
+    parser.add_argument("--index_types", type=str, nargs='+', default=['flat', 'hnsw', 'ivf'],
+                        help="Index types to compare.")
+    parser.add_argument("--compressions", type=str, nargs='+', default=list(COMPRESSIONS),
+                        help="Vector encodings to compare.")
+    args = parser.parse_args()
+    main(**vars(args))
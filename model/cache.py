@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+current_path = os.path.abspath(__file__)
+current_dir = os.path.dirname(current_path)
+
+# read when a cache is opened, benchmarks point it elsewhere to start from empty caches
+CACHE_DIR = os.path.join(os.path.dirname(current_dir), 'cache')
+SUMMARY_CACHE = 'summary_cache.sqlite'
+EMBEDDING_CACHE = 'embedding_cache.sqlite'
+SNIPPET_CACHE = 'snippet_cache.sqlite'
+MAX_SUMMARY_ENTRIES = 500000
+MAX_EMBEDDING_ENTRIES = 1000000
+MAX_SNIPPET_ENTRIES = 500000
+# sqlite host parameter limit
+SQL_BATCH = 500
+
+
+def cache_path(file_name):
+    return os.path.join(CACHE_DIR, file_name)
+
+
+def text_hash(*parts):
+    hasher = hashlib.sha256()
+    for part in parts:
+        hasher.update(str(part).encode('utf-8'))
+        hasher.update(b'\0')
+    return hasher.hexdigest()
+
+
+class LruCache:
+    # sqlite table of key -> value with the time each entry was last used, entries beyond max_entries are evicted
+    # least recently used first. the lock lets the indexing and the query path share a cache across threads
+    table = None
+    column = None
+    column_type = None
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table} "
+                          f"(key TEXT PRIMARY KEY, {self.column} {self.column_type} NOT NULL, last_used REAL NOT NULL)")
+        self.conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table}_last_used ON {self.table} (last_used)")
+        self.conn.commit()
+
+    def encode(self, value):
+        return value
+
+    def decode(self, value):
+        return value
+
+    def get_many(self, keys):
+        # return {key: value} for cached keys and refresh their lru timestamp
+        found = {}
+        unique_keys = list(set(keys))
+        with self.lock:
+            for i in range(0, len(unique_keys), SQL_BATCH):
+                chunk = unique_keys[i:i + SQL_BATCH]
+                rows = self.conn.execute(f"SELECT key, {self.column} FROM {self.table} "
+                                         f"WHERE key IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+                for key, value in rows:
+                    found[key] = self.decode(value)
+            if found:
+                now = time.time()
+                self.conn.executemany(f"UPDATE {self.table} SET last_used = ? WHERE key = ?",
+                                      [(now, key) for key in found])
+                self.conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items):
+        if not items:
+            return
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(f"INSERT OR REPLACE INTO {self.table} (key, {self.column}, last_used) "
+                                  f"VALUES (?, ?, ?)", [(key, self.encode(value), now) for key, value in items])
+            self.conn.commit()
+
+    def evict(self):
+        # drop least recently used entries beyond the size cap
+        with self.lock:
+            count = self.conn.execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(f"DELETE FROM {self.table} WHERE key IN "
+                                  f"(SELECT key FROM {self.table} ORDER BY last_used ASC LIMIT ?)",
+                                  (count - self.max_entries,))
+                self.conn.commit()
+                return count - self.max_entries
+        return 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+    def close(self):
+        self.evict()
+        self.conn.close()
+
+
+class SummaryCache(LruCache):
+    table = 'summaries'
+    column = 'summary'
+    column_type = 'TEXT'
+
+    def __init__(self, model_name, prompt_version, language, path=None, max_entries=MAX_SUMMARY_ENTRIES):
+        self.model_name = model_name
+        self.prompt_version = prompt_version
+        self.language = language
+        super().__init__(path or cache_path(SUMMARY_CACHE), max_entries)
+
+    def key(self, content):
+        return text_hash(self.model_name, self.prompt_version, self.language, content)
+
+
+class EmbeddingCache(LruCache):
+    table = 'embeddings'
+    column = 'vector'
+    column_type = 'BLOB'
+
+    def __init__(self, model_name, path=None, max_entries=MAX_EMBEDDING_ENTRIES):
+        self.model_name = model_name
+        super().__init__(path or cache_path(EMBEDDING_CACHE), max_entries)
+
+    def key(self, text):
+        return text_hash(self.model_name, text)
+
+    def encode(self, vector):
+        return np.asarray(vector, dtype=np.float32).tobytes()
+
+    def decode(self, vector):
+        return np.frombuffer(vector, dtype=np.float32).tolist()
+
+
+class SnippetCache(LruCache):
+    # parsed snippets of a file keyed by its git blob sha, identical files of different commits are parsed once.
+    # values are [(class_name, content, position)]
+    table = 'snippets'
+    column = 'snippets'
+    column_type = 'TEXT'
+
+    def __init__(self, parser_name, parser_version, path=None, max_entries=MAX_SNIPPET_ENTRIES):
+        self.parser_name = parser_name
+        self.parser_version = parser_version
+        super().__init__(path or cache_path(SNIPPET_CACHE), max_entries)
+
+    def key(self, blob_sha):
+        return text_hash(self.parser_name, self.parser_version, blob_sha)
+
+    def encode(self, snippets):
+        return json.dumps(snippets)
+
+    def decode(self, snippets):
+        return [(class_name, content, tuple(position)) for class_name, content, position in json.loads(snippets)]
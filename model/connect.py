@@ -1,3 +1,5 @@
+import threading
+
 import openai
 from langchain_core.prompts import ChatPromptTemplate
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
@@ -9,6 +11,16 @@ from model.prompt import prompt_list_for_error_message
 
 MAX_RETRY = 3
 RETRY_WAIT_TIME = 30
+# raised to the caller once the retries are spent, the request may succeed when it is run again
+TRANSIENT_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+# every request fails the same way until the api key or model name is fixed
+ACCOUNT_ERRORS = (openai.AuthenticationError, openai.PermissionDeniedError, openai.NotFoundError)
+
+
+def print_retry(retry_state):
+    # only called when another attempt follows
+    error = retry_state.outcome.exception()
+    print(f"{type(error).__name__}: {error}. Retrying in {RETRY_WAIT_TIME} seconds.")
 
 
 class Openai:
@@ -27,13 +39,20 @@ class Openai:
         self.prompt_list_history = []
         self.input_dict_history = {}
         self.token_usage = 0
+        # invoke may be called from summarization worker threads
+        self.token_usage_lock = threading.Lock()
 
     @retry(
-        retry=retry_if_exception_type(openai.RateLimitError),
+        retry=retry_if_exception_type(TRANSIENT_ERRORS),
         stop=stop_after_attempt(MAX_RETRY),
-        wait=wait_fixed(RETRY_WAIT_TIME)
+        wait=wait_fixed(RETRY_WAIT_TIME),
+        before_sleep=print_retry,
+        reraise=True
     )
-    def invoke(self, prompt_list, input_dict, output_parser=FileOutputParser(), record=True):
+    def invoke(self, prompt_list, input_dict, output_parser=FileOutputParser(), record=True,
+               raise_account_errors=False):
+        # transient errors are raised once the retries are spent, other errors are printed and None is returned.
+        # with raise_account_errors, authentication, permission and model errors are raised as well
         prompt = ChatPromptTemplate.from_messages(prompt_list)
         if record:
             self.prompt_list_history = prompt_list
@@ -41,20 +60,24 @@ class Openai:
         chain = prompt | self.model
         try:
             response = chain.invoke(input_dict)
-            self.token_usage += response.response_metadata["token_usage"]["total_tokens"]
+            with self.token_usage_lock:
+                self.token_usage += response.response_metadata["token_usage"]["total_tokens"]
             if output_parser:
                 response = output_parser.parse(response.content)
             if record:
                 self.prompt_list_history.append(("ai", "<parsed_ai_response>{ai_response_1}</parsed_ai_response>"))
                 self.input_dict_history["ai_response_1"] = str(response)
             return response
-        except openai.AuthenticationError as auth_err:
-            print(f"Authentication failed: {str(auth_err)}")
-        except openai.NotFoundError as not_found_err:
-            print(f"Model not found or access denied: {str(not_found_err)}")
-            print("You can try model names like 'gpt-4o', 'gpt-4o-mini', 'gpt-3.5-turbo-16k' etc.")
-        except openai.RateLimitError as e:
-            print(f"Rate limit error: {e}. Retrying in {RETRY_WAIT_TIME} seconds.")
+        except TRANSIENT_ERRORS:
+            raise
+        except ACCOUNT_ERRORS as account_err:
+            if isinstance(account_err, openai.AuthenticationError):
+                print(f"Authentication failed: {str(account_err)}")
+            else:
+                print(f"Model not found or access denied: {str(account_err)}")
+                print("You can try model names like 'gpt-4o', 'gpt-4o-mini', 'gpt-3.5-turbo-16k' etc.")
+            if raise_account_errors:
+                raise
         except Exception as e:
             print(f"An error occurred: {str(e)}")
 
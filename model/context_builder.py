@@ -0,0 +1,126 @@
+from model.summarizer import estimate_tokens
+from utils.code_parser import get_code_parser
+
+# prompt tokens spent on retrieved code, counted with the tokenizer of the chat model
+CONTEXT_TOKEN_BUDGET = 12000
+# retrieved snippets offered to the context builder, best first
+CONTEXT_CANDIDATES = 20
+# lines kept around each snippet
+CONTEXT_LINES = 3
+# smallest remainder of the budget still filled with the head of a snippet that does not fit
+MIN_PARTIAL_TOKENS = 200
+FALLBACK_ENCODING = 'cl100k_base'
+
+
+def token_counter(model_name):
+    # tiktoken counts locally, the character estimate is used when it or its encoding files are not available
+    try:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception:
+        print(f"No local tiktoken encoding for {model_name}, token counts are estimated.")
+        return estimate_tokens
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def file_prefix(file_name):
+    return f'[start of {file_name}]\n'
+
+
+def file_postfix(file_name):
+    return f'[end of {file_name}]\n'
+
+
+def numbered_line(idx, line):
+    # same numbering as read_file_with_index, so positions given by the model index the lines of the file
+    return f"[{idx}]{line}" if line.endswith('\n') else f"[{idx}]{line}\n"
+
+
+class ContextBuilder:
+    def __init__(self, language, model_name="gpt-4o-mini", token_budget=CONTEXT_TOKEN_BUDGET,
+                 context_lines=CONTEXT_LINES, count_tokens=None):
+        self.code_parser = get_code_parser(language)
+        self.token_budget = token_budget
+        self.context_lines = context_lines
+        self.count_tokens = count_tokens or token_counter(model_name)
+        self.file_lines = {}
+        self.line_tokens = {}
+        self.selected = {}
+
+    def read_lines(self, file_name):
+        if file_name not in self.file_lines:
+            with open(file_name, 'r', encoding='utf-8') as file:
+                self.file_lines[file_name] = file.readlines()
+        return self.file_lines[file_name]
+
+    def tokens_of_line(self, file_name, idx):
+        key = (file_name, idx)
+        if key not in self.line_tokens:
+            self.line_tokens[key] = self.count_tokens(numbered_line(idx, self.file_lines[file_name][idx]))
+        return self.line_tokens[key]
+
+    def snippet_lines(self, doc):
+        # documents indexed before positions were stored fall back to the whole file
+        lines = self.read_lines(doc.metadata['file_name'])
+        position = doc.metadata.get('position')
+        if position is None:
+            return 0, len(lines)
+        start, end = self.code_parser.line_range(''.join(lines), position)
+        return max(0, start - self.context_lines), min(len(lines), end + self.context_lines)
+
+    def build(self, matched_docs):
+        # pack snippets in retrieval order until the budget is spent, overlapping snippets share their lines.
+        # returns the numbered context and the number of tokens it uses
+        selected = {}
+        used = 0
+        for doc in matched_docs:
+            file_name = doc.metadata['file_name']
+            start, end = self.snippet_lines(doc)
+            lines = selected.get(file_name, set())
+            new_lines = [idx for idx in range(start, end) if idx not in lines]
+            if not new_lines:
+                continue
+            cost = 0 if file_name in selected else \
+                self.count_tokens(file_prefix(file_name)) + self.count_tokens(file_postfix(file_name))
+            header_cost = cost
+            for idx in new_lines:
+                cost += self.tokens_of_line(file_name, idx)
+            if self.token_budget is not None and used + cost > self.token_budget:
+                remaining = self.token_budget - used - header_cost
+                if remaining < MIN_PARTIAL_TOKENS:
+                    continue
+                # keep the head of the snippet, where its declaration is
+                head, cost = [], header_cost
+                for idx in new_lines:
+                    line_cost = self.tokens_of_line(file_name, idx)
+                    if cost + line_cost > self.token_budget - used:
+                        break
+                    head.append(idx)
+                    cost += line_cost
+                if not head:
+                    # not even the first line fits, the file would only add its header
+                    continue
+                new_lines = head
+            selected.setdefault(file_name, set()).update(new_lines)
+            used += cost
+        # file name -> line numbers in the context
+        self.selected = selected
+        return self.render(selected), used
+
+    def render(self, selected):
+        code_with_location = ''
+        for file_name, lines in selected.items():
+            file_lines = self.file_lines[file_name]
+            code = ''
+            last_idx = None
+            for idx in sorted(lines):
+                if last_idx is not None and idx != last_idx + 1:
+                    code += '[...]\n'
+                code += numbered_line(idx, file_lines[idx])
+                last_idx = idx
+            code_with_location += file_prefix(file_name) + code + file_postfix(file_name)
+        return code_with_location
@@ -0,0 +1,40 @@
+from model.cache import EmbeddingCache
+
+
+class CachedEmbeddings:
+    def __init__(self, embeddings_model, model_name=None, cache=None):
+        # embeddings_model may be a factory, the client is then only created when a text misses the cache
+        self._embeddings_model = embeddings_model
+        self.model_name = model_name if model_name else getattr(embeddings_model, 'model',
+                                                                type(embeddings_model).__name__)
+        self.cache = cache if cache else EmbeddingCache(self.model_name)
+
+    @property
+    def embeddings_model(self):
+        if callable(self._embeddings_model) and not hasattr(self._embeddings_model, 'embed_documents'):
+            self._embeddings_model = self._embeddings_model()
+        return self._embeddings_model
+
+    def embed_documents(self, texts):
+        keys = [self.cache.key(text) for text in texts]
+        cached = self.cache.get_many(keys)
+        # embed every distinct missing text once, in a single batched request
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in missing:
+                missing[key] = text
+        if missing:
+            vectors = self.embeddings_model.embed_documents(list(missing.values()))
+            new_items = list(zip(missing.keys(), vectors))
+            self.cache.put_many(new_items)
+            cached.update(new_items)
+        return [cached[key] for key in keys]
+
+    def embed_query(self, text):
+        key = self.cache.key(text)
+        cached = self.cache.get_many([key])
+        if key in cached:
+            return cached[key]
+        vector = self.embeddings_model.embed_query(text)
+        self.cache.put_many([(key, vector)])
+        return vector
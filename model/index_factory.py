@@ -0,0 +1,177 @@
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ('auto', 'flat', 'hnsw', 'ivf')
+# vector encodings: full precision, half precision, 8-bit scalar quantization and product quantization
+COMPRESSIONS = ('none', 'fp16', 'int8', 'pq')
+# corpus sizes above which the approximate index types pay off
+HNSW_MIN_SIZE = 20000
+IVF_MIN_SIZE = 200000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+IVF_NPROBE = 16
+# faiss needs about 39 training points per ivf centroid
+IVF_POINTS_PER_CENTROID = 39
+# dimensions per pq sub-quantizer, each encoded in one byte
+PQ_DIMS_PER_CODE = 8
+# pq trains 256 centroids per sub-quantizer, smaller corpora fall back to int8
+PQ_MIN_SIZE = 256 * IVF_POINTS_PER_CENTROID
+
+
+def select_index_type(size, index_type='auto'):
+    if index_type != 'auto':
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unsupported index type {index_type}. Choose from {', '.join(INDEX_TYPES)}.")
+        return index_type
+    if size >= IVF_MIN_SIZE:
+        return 'ivf'
+    if size >= HNSW_MIN_SIZE:
+        return 'hnsw'
+    return 'flat'
+
+
+def ivf_nlist(size):
+    nlist = int(4 * math.sqrt(max(size, 1)))
+    return max(1, min(nlist, size // IVF_POINTS_PER_CENTROID))
+
+
+def select_compression(size, compression='none'):
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unsupported compression {compression}. Choose from {', '.join(COMPRESSIONS)}.")
+    if compression == 'pq' and size < PQ_MIN_SIZE:
+        return 'int8'
+    return compression
+
+
+def pq_code_size(dim):
+    # number of sub-quantizers has to divide the dimension
+    m = max(1, dim // PQ_DIMS_PER_CODE)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def encoding_description(dim, compression):
+    if compression == 'fp16':
+        return 'SQfp16'
+    if compression == 'int8':
+        return 'SQ8'
+    if compression == 'pq':
+        return f'PQ{pq_code_size(dim)}'
+    return 'Flat'
+
+
+def index_description(index_type, size, dim=0, compression='none'):
+    encoding = encoding_description(dim, compression)
+    if index_type == 'hnsw':
+        return f'HNSW{HNSW_M},{encoding}'
+    if index_type == 'ivf':
+        return f'IVF{ivf_nlist(size)},{encoding}'
+    return encoding
+
+
+def normalize(vectors):
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if len(vectors):
+        faiss.normalize_L2(vectors)
+    return vectors
+
+
+def set_search_params(index, index_type):
+    if index_type == 'hnsw':
+        faiss.downcast_index(index).hnsw.efSearch = HNSW_EF_SEARCH
+    elif index_type == 'ivf':
+        faiss.extract_index_ivf(index).nprobe = IVF_NPROBE
+
+
+def read_index(path, index_type):
+    # faiss 1.8 only memory maps the inverted lists of ivf indexes, the codes of flat and hnsw indexes are read
+    # into memory whatever the flags, so their load time and memory grow with the number of vectors
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if index_type == 'ivf' else 0
+    index = faiss.read_index(path, flags)
+    set_search_params(index, index_type)
+    return index
+
+
+def create_index(dim, index_type='flat', size=0, compression='none'):
+    index = faiss.index_factory(dim, index_description(index_type, size, dim, compression),
+                                faiss.METRIC_INNER_PRODUCT)
+    if index_type == 'hnsw':
+        faiss.downcast_index(index).hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    set_search_params(index, index_type)
+    return index
+
+
+def build_index(vectors, dim, index_type='flat', compression='none'):
+    # vectors are expected normalized, the order is kept so positions in the docstore map stay valid
+    index = create_index(dim, index_type, len(vectors), compression)
+    if not index.is_trained:
+        index.train(vectors)
+    if len(vectors):
+        index.add(vectors)
+    return index
+
+
+def reconstruct_vectors(index):
+    # exact for flat indexes, approximate for compressed ones
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def reconstruct_ids(index, ids):
+    # vectors of the given ids, approximate for compressed indexes. ivf indexes need a direct map from id to list
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None and ivf.direct_map.type == faiss.DirectMap.NoMap:
+        ivf.make_direct_map()
+    return index.reconstruct_batch(np.asarray(ids, dtype=np.int64))
+
+
+def group_vectors(vectors, groups, names):
+    # one normalized mean vector per name, over the vectors whose group is that name
+    positions = {name: idx for idx, name in enumerate(names)}
+    sums = np.zeros((len(names), vectors.shape[1]), dtype=np.float32)
+    np.add.at(sums, [positions[group] for group in groups], vectors)
+    return normalize(sums)
+
+
+def id_mapped_index(dim):
+    # ids stay stable when other vectors are removed, so documents are keyed by id instead of position
+    return faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+
+
+def search_parameters(index, index_type, excluded_ids=(), included_ids=None):
+    # excluded ids are skipped inside the faiss search, or only included ids are searched when given.
+    # flat product quantized indexes do not support it.
+    # the selectors are returned with the parameters since faiss does not keep them alive
+    if isinstance(faiss.downcast_index(index), faiss.IndexPQ):
+        return None, None
+    if included_ids is not None:
+        batch = faiss.IDSelectorBatch(np.asarray(included_ids, dtype=np.int64))
+        selector = batch
+    else:
+        batch = faiss.IDSelectorBatch(np.asarray(excluded_ids, dtype=np.int64))
+        selector = faiss.IDSelectorNot(batch)
+    if index_type == 'hnsw':
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=HNSW_EF_SEARCH)
+    elif index_type == 'ivf':
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=IVF_NPROBE)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    return params, (batch, selector)
+
+
+def widened_parameters(params, index_type, factor):
+    # the same selector searched with factor times the hnsw candidates or the ivf lists, approximate indexes only
+    # visit part of the vectors and can find fewer than k that pass the selector
+    if index_type == 'hnsw':
+        return faiss.SearchParametersHNSW(sel=params.sel, efSearch=HNSW_EF_SEARCH * factor)
+    if index_type == 'ivf':
+        return faiss.SearchParametersIVF(sel=params.sel, nprobe=IVF_NPROBE * factor)
+    return params
@@ -0,0 +1,52 @@
+import math
+import re
+from collections import Counter
+
+# bm25 parameters
+BM25_K1 = 1.2
+BM25_B = 0.75
+# reciprocal rank fusion constant
+RRF_K = 60
+
+TOKEN_PATTERN = re.compile(r'[A-Za-z_$][A-Za-z0-9_$]*|\d+')
+# splits camelCase, PascalCase and snake_case identifiers into their words
+WORD_PATTERN = re.compile(r'[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|\d+')
+STOP_WORDS = {
+    # english
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in', 'is', 'it', 'of', 'on', 'or', 'that',
+    'the', 'this', 'to', 'with', 'all', 'can', 'should', 'will', 'when', 'add', 'change', 'make',
+    # dart and python keywords
+    'abstract', 'async', 'await', 'bool', 'break', 'case', 'catch', 'class', 'const', 'continue', 'def', 'default',
+    'double', 'dynamic', 'elif', 'else', 'enum', 'extends', 'false', 'final', 'finally', 'if', 'implements',
+    'import', 'int', 'late', 'mixin', 'new', 'none', 'null', 'override', 'pass', 'required', 'return', 'self',
+    'static', 'string', 'super', 'true', 'try', 'var', 'void', 'while', 'yield',
+}
+
+
+def tokenize(text):
+    terms = []
+    for token in TOKEN_PATTERN.findall(text):
+        words = [word.lower() for word in WORD_PATTERN.findall(token)]
+        # keep the whole identifier so exact class names score above their parts
+        if len(words) > 1:
+            terms.append(token.lower())
+        terms.extend(words)
+    return [term for term in terms if len(term) > 1 and term not in STOP_WORDS]
+
+
+def term_frequencies(text):
+    return Counter(tokenize(text))
+
+
+def bm25_score(tf, df, length, num_docs, avg_length):
+    idf = math.log(1 + (num_docs - df + 0.5) / (df + 0.5))
+    return idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * length / max(avg_length, 1e-9)))
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    # rankings are lists of keys, best first. returns keys ordered by fused score
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=lambda key: scores[key], reverse=True)
@@ -90,6 +90,10 @@ def prompt_list_for_error_message(iteration=1):
             ]
     return prompt_list
 
+# bump when the summarize prompt changes so cached summaries are not reused
+SUMMARIZE_PROMPT_VERSION = 1
+
+
 def prompt_list_for_summarize_code(language='flutter', if_code=True):
     if if_code:
         prompt_text = '''Explain the functionality of a ''' + language + '''project code snippet from code file 
@@ -0,0 +1,167 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from model.prompt import prompt_list_for_summarize_code
+from utils.code_parser import CHARS_PER_TOKEN
+
+MAX_CONCURRENCY = 8
+# token per minute budget of concurrent summary requests when none is given, below the tier 1 limit of gpt-4o-mini.
+# 0 disables the limit
+TOKENS_PER_MINUTE = 150000
+# completion tokens reserved per summary request before the real usage is known
+COMPLETION_TOKEN_ESTIMATE = 256
+PROMPT_TOKEN_OVERHEAD = 80
+RATE_WINDOW = 60
+
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class TokenRateLimiter:
+    def __init__(self, tokens_per_minute=None):
+        self.tokens_per_minute = tokens_per_minute
+        self.lock = threading.Lock()
+        # (timestamp, tokens) of requests inside the sliding window
+        self.window = deque()
+        self.used = 0
+
+    def _expire(self, now):
+        while self.window and now - self.window[0][0] >= RATE_WINDOW:
+            self.used -= self.window.popleft()[1]
+
+    def acquire(self, tokens):
+        if not self.tokens_per_minute:
+            return
+        # a single request larger than the budget is allowed once the window is empty
+        tokens = min(tokens, self.tokens_per_minute)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self._expire(now)
+                if self.used + tokens <= self.tokens_per_minute:
+                    self.window.append((now, tokens))
+                    self.used += tokens
+                    return
+                wait_time = RATE_WINDOW - (now - self.window[0][0])
+            time.sleep(max(wait_time, 0.05))
+
+    def adjust(self, estimated, actual):
+        # replace the estimate with the real token usage reported by the api
+        if not self.tokens_per_minute or actual == estimated:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.window.append((now, actual - estimated))
+            self.used += actual - estimated
+
+
+class CodeSummarizer:
+    def __init__(self, llm, language, max_concurrency=MAX_CONCURRENCY, tokens_per_minute=None, cache=None):
+        # llm may be a factory, the client is then only created when a snippet misses the cache
+        self._llm = llm
+        self.llm_lock = threading.Lock()
+        self.cache = cache
+        self.language = language
+        self.max_concurrency = max(1, max_concurrency)
+        if tokens_per_minute is None and self.max_concurrency > 1:
+            tokens_per_minute = TOKENS_PER_MINUTE
+        self.rate_limiter = TokenRateLimiter(tokens_per_minute)
+        # first request that failed for a reason the next run may not have, summarize raises it once the requests
+        # in flight are collected
+        self.error = None
+        self.prompt_list = prompt_list_for_summarize_code(language, True)
+        # cache key -> future of a request not collected yet, identical snippets share it
+        self.in_flight = {}
+
+    @property
+    def llm(self):
+        with self.llm_lock:
+            if callable(self._llm):
+                self._llm = self._llm()
+        return self._llm
+
+    def summarize_snippet(self, file_name, content):
+        estimated = estimate_tokens(content) + PROMPT_TOKEN_OVERHEAD + COMPLETION_TOKEN_ESTIMATE
+        self.rate_limiter.acquire(estimated)
+        input_dict = {"file_name": file_name, "source_code": content}
+        response = self.llm.invoke(prompt_list=self.prompt_list, input_dict=input_dict, output_parser=None,
+                                   record=False, raise_account_errors=True)
+        if response is None:
+            # rejected for its content or length, it fails the same way on every run
+            self.rate_limiter.adjust(estimated, 0)
+            print(f"No summary for a snippet of {file_name}, its code is embedded instead.")
+            return None
+        token_usage = response.response_metadata.get("token_usage", {}).get("total_tokens", estimated)
+        self.rate_limiter.adjust(estimated, token_usage)
+        return response.content
+
+    def _submit(self, executor, file_name, snippets):
+        if not self.cache:
+            return [executor.submit(self.summarize_snippet, file_name, snippet[1]) for snippet in snippets], None
+        keys = [self.cache.key(snippet[1]) for snippet in snippets]
+        cached = self.cache.get_many(keys)
+        futures, new_keys = [], []
+        for snippet, key in zip(snippets, keys):
+            if key in cached:
+                future = Future()
+                future.set_result(cached[key])
+            elif key in self.in_flight:
+                # the first snippet with this content writes the summary to the cache
+                future = self.in_flight[key]
+                key = None
+            else:
+                future = executor.submit(self.summarize_snippet, file_name, snippet[1])
+                self.in_flight[key] = future
+            futures.append(future)
+            new_keys.append(key if key not in cached else None)
+        return futures, new_keys
+
+    def _collect(self, file_name, snippets, futures, keys):
+        results = []
+        new_summaries = []
+        for idx, (snippet, future) in enumerate(zip(snippets, futures)):
+            try:
+                summary = future.result()
+            except Exception as e:
+                print("Error occurred when creating code summary:", e)
+                self.error = self.error or e
+                summary = None
+            if keys and keys[idx] and summary is not None:
+                new_summaries.append((keys[idx], summary))
+            results.append((snippet, summary))
+        if self.cache:
+            self.cache.put_many(new_summaries)
+            for key in keys:
+                self.in_flight.pop(key, None)
+        return file_name, results
+
+    def summarize(self, file_snippets):
+        # summarize (file_name, snippets) pairs with at most max_concurrency requests in flight,
+        # yield (file_name, [(snippet, summary)]) in input order.
+        # cached summaries are resolved before submitting, new ones are written back when collected
+        # bound the number of files queued ahead of the consumer so memory stays flat.
+        # a snippet the api rejects has the summary None. after a request failed for a transient or account
+        # error no more files are submitted, the summaries in flight are cached and the error is raised, so no
+        # snapshot missing the failed snippets is saved and the next run summarizes them again
+        max_pending_files = self.max_concurrency * 4
+        self.error = None
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            pending = deque()
+            for file_name, snippets in file_snippets:
+                if self.error:
+                    break
+                futures, keys = self._submit(executor, file_name, snippets)
+                pending.append((file_name, snippets, futures, keys))
+                while len(pending) > max_pending_files or (pending and all(f.done() for f in pending[0][2])):
+                    result = self._collect(*pending.popleft())
+                    if not self.error:
+                        yield result
+            while pending:
+                result = self._collect(*pending.popleft())
+                if not self.error:
+                    yield result
+        if self.error:
+            raise RuntimeError("Code summary failed, the vector store is not saved.") from self.error
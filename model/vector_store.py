@@ -1,122 +1,658 @@
 import json
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
 
 import faiss
-from langchain_community.docstore import InMemoryDocstore
-from langchain_community.vectorstores import FAISS
+import numpy as np
 import os
 
+from model.cache import SQL_BATCH
+from model.embeddings import CachedEmbeddings
+from model.index_factory import select_index_type, select_compression, build_index, reconstruct_vectors, \
+    normalize, id_mapped_index, search_parameters, group_vectors, read_index, reconstruct_ids, \
+    widened_parameters
+from model.lexical_index import term_frequencies, tokenize, bm25_score, reciprocal_rank_fusion
+
 
 current_path = os.path.abspath(__file__)
 current_dir = os.path.dirname(current_path)
 
 VS_DIR = os.path.dirname(current_dir)
 VECTORSTORE = os.path.join(VS_DIR, 'vectorstore')
+# documents embedded per request, across files
+EMBED_BATCH_SIZE = 1000
+# merge the live documents of a snapshot into one segment once it references more segments than this
+MAX_SEGMENTS = 8
+# or once most of the documents in its segments belong to other snapshots
+MAX_DEAD_RATIO = 0.5
+# growth of candidates fetched per segment when documents of files not live in the snapshot are dropped
+FETCH_FACTOR = 4
+# candidates taken from each of the vector and lexical rankings before fusing them
+HYBRID_CANDIDATES = 20
+# files whose snippets are searched in the second retrieval stage
+TOP_FILES = 10
+# snippets of one file ranked before the second best snippets of the other files
+SNIPPETS_PER_FILE = 2
+
+
+def project_dir(project_name):
+    return os.path.join(VECTORSTORE, project_name)
+
+
+def segment_dir(project_name, segment_id):
+    return os.path.join(project_dir(project_name), 'segments', segment_id)
+
+
+def manifest_path(project_name, sha):
+    return os.path.join(project_dir(project_name), 'manifests', f'{sha}.json')
+
+
+def indexed_shas(project_name):
+    # sha -> last use of every snapshot of the project
+    manifest_dir = os.path.join(project_dir(project_name), 'manifests')
+    if not os.path.isdir(manifest_dir):
+        return {}
+    return {file[:-len('.json')]: os.path.getmtime(os.path.join(manifest_dir, file))
+            for file in os.listdir(manifest_dir) if file.endswith('.json')}
+
+
+def write_json(path, data):
+    # write to a temporary file first so readers never see a partial manifest
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def dir_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
+
+
+class Segment:
+    # immutable group of documents of a set of files, shared by every snapshot that references it.
+    # documents live in sqlite and are read per query, so loading reads no documents. the faiss index of an ivf
+    # segment is memory mapped, flat and hnsw indexes are read into memory.
+    # a segment being written keeps its documents in memory on an id mapped index until it is saved
+    def __init__(self, segment_id, index, files, index_type='flat', compression='none', conn=None, file_index=None):
+        self.segment_id = segment_id
+        self.index = index
+        self.files = set(files)
+        # file level index with the mean snippet vector of every file, in the order of file_names.
+        # segments saved before it existed have none and are only searched by snippet
+        self.file_index = file_index
+        self.file_names = sorted(files)
+        self.index_type = index_type
+        self.compression = compression
+        # saved segments: sqlite with the vector id of every document, indexed by file name
+        self.conn = conn
+        # segment being written: vector id -> document and file name -> vector ids
+        self.docs = {} if conn is None else None
+        self.file_ids = {}
+        self.next_id = 0
+        # vector id -> term frequencies of the snippet, kept in the terms table once saved
+        self.doc_terms = {}
+        self.has_terms = conn is None or conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'terms'").fetchone() is not None
+        # file name -> (documents, total terms) of a saved segment, read once for bm25 statistics
+        self.file_stats = None
+        # (dead files, search parameters excluding their vectors, selectors kept alive for faiss)
+        self.excluded = (frozenset(), None, None)
+        # guards the direct map an ivf index builds on its first reconstruction
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, dim=None):
+        index = id_mapped_index(dim) if dim else None
+        return cls(f'{int(time.time())}-{uuid.uuid4().hex[:12]}', index, [])
+
+    @classmethod
+    def load(cls, project_name, segment_id):
+        path = segment_dir(project_name, segment_id)
+        with open(os.path.join(path, 'segment.json'), 'r') as f:
+            meta = json.load(f)
+        index = read_index(os.path.join(path, 'index.faiss'), meta["index_type"])
+        conn = sqlite3.connect(f'file:{os.path.join(path, "docs.sqlite")}?mode=ro', uri=True,
+                               check_same_thread=False)
+        file_index = None
+        if os.path.isfile(os.path.join(path, 'files.faiss')):
+            file_index = read_index(os.path.join(path, 'files.faiss'), 'flat')
+        return cls(segment_id, index, meta["files"], meta["index_type"], meta["compression"], conn, file_index)
+
+    @property
+    def ntotal(self):
+        return self.index.ntotal if self.index is not None else 0
+
+    def ordered_ids(self):
+        # vector ids in the order of the vectors inside the id mapped index
+        return faiss.vector_to_array(self.index.id_map)
+
+    def save(self, project_name, index_type='auto', compression='none'):
+        # documents are stored at the position of their vector in the final index, which replaces the id map
+        docs = self.documents()
+        doc_terms = self.term_counts()
+        vectors = self.exact_vectors()
+        index_type = select_index_type(len(vectors), index_type)
+        compression = select_compression(len(vectors), compression)
+        self.file_names = sorted(self.files)
+        self.file_index = build_index(
+            group_vectors(vectors, [doc.metadata['file_name'] for doc in docs], self.file_names), self.index.d)
+        self.index = build_index(vectors, self.index.d, index_type, compression)
+        self.index_type, self.compression = index_type, compression
+        print(f"Vector index built as {index_type} with {compression} compression for {len(vectors)} vectors.")
+
+        path = segment_dir(project_name, self.segment_id)
+        os.makedirs(path, exist_ok=True)
+        faiss.write_index(self.index, os.path.join(path, 'index.faiss'))
+        faiss.write_index(self.file_index, os.path.join(path, 'files.faiss'))
+        conn = sqlite3.connect(os.path.join(path, 'docs.sqlite'), check_same_thread=False)
+        conn.execute("CREATE TABLE documents (id INTEGER PRIMARY KEY, file_name TEXT NOT NULL, "
+                     "page_content TEXT NOT NULL, metadata TEXT NOT NULL, length INTEGER NOT NULL)")
+        conn.execute("CREATE INDEX documents_file_name ON documents (file_name)")
+        conn.executemany("INSERT INTO documents (id, file_name, page_content, metadata, length) "
+                         "VALUES (?, ?, ?, ?, ?)",
+                         [(idx, doc.metadata['file_name'], doc.page_content, json.dumps(doc.metadata),
+                           sum(terms.values())) for idx, (doc, terms) in enumerate(zip(docs, doc_terms))])
+        # inverted index of snippet terms for lexical retrieval
+        conn.execute("CREATE TABLE terms (term TEXT NOT NULL, id INTEGER NOT NULL, tf INTEGER NOT NULL)")
+        conn.executemany("INSERT INTO terms (term, id, tf) VALUES (?, ?, ?)",
+                         [(term, idx, tf) for idx, terms in enumerate(doc_terms) for term, tf in terms.items()])
+        conn.execute("CREATE INDEX terms_term ON terms (term)")
+        conn.commit()
+        # the segment.json is written last and marks the segment as complete
+        write_json(os.path.join(path, 'segment.json'), {"files": sorted(self.files),
+                                                         "index_type": self.index_type,
+                                                         "compression": self.compression,
+                                                         "dim": self.index.d,
+                                                         "ntotal": self.ntotal})
+        self.conn, self.docs, self.file_ids, self.doc_terms, self.has_terms = conn, None, {}, {}, True
+
+    def add_embeddings(self, texts, embeddings, metadatas, lexical_texts=None):
+        from langchain_core.documents import Document
+
+        if self.index is None:
+            # dimension of a new store is only known once the first vectors arrive
+            self.index = id_mapped_index(len(embeddings[0]))
+        ids = np.arange(self.next_id, self.next_id + len(texts), dtype=np.int64)
+        self.next_id += len(texts)
+        if lexical_texts is None:
+            lexical_texts = texts
+        for idx, text, metadata, lexical_text in zip(ids.tolist(), texts, metadatas, lexical_texts):
+            file_name = metadata['file_name']
+            self.docs[idx] = Document(page_content=text, metadata=metadata)
+            # lexical texts may already be term frequencies, when documents are copied between segments
+            self.doc_terms[idx] = lexical_text if isinstance(lexical_text, dict) else term_frequencies(lexical_text)
+            self.file_ids.setdefault(file_name, []).append(idx)
+            self.files.add(file_name)
+        self.index.add_with_ids(normalize(embeddings), ids)
+
+    def delete_files(self, file_names):
+        # only valid before the segment is saved, saved segments are never changed.
+        # the vectors of all files are removed in one batched call
+        ids = []
+        for file_name in file_names:
+            ids.extend(self.file_ids.pop(file_name, []))
+            self.files.discard(file_name)
+        if ids:
+            self.index.remove_ids(np.array(ids, dtype=np.int64))
+            for idx in ids:
+                del self.docs[idx]
+                del self.doc_terms[idx]
+
+    def file_vector_ids(self, file_names):
+        if self.docs is not None:
+            return [idx for file_name in file_names for idx in self.file_ids.get(file_name, [])]
+        ids = []
+        file_names = list(file_names)
+        for i in range(0, len(file_names), SQL_BATCH):
+            chunk = file_names[i:i + SQL_BATCH]
+            ids.extend(row[0] for row in self.conn.execute(
+                f"SELECT id FROM documents WHERE file_name IN ({','.join('?' * len(chunk))})", chunk))
+        return ids
+
+    def get_documents(self, ids):
+        from langchain_core.documents import Document
+
+        if self.docs is not None:
+            return {idx: self.docs[idx] for idx in ids}
+        documents = {}
+        ids = [int(idx) for idx in ids]
+        for i in range(0, len(ids), SQL_BATCH):
+            chunk = ids[i:i + SQL_BATCH]
+            rows = self.conn.execute(f"SELECT id, page_content, metadata FROM documents "
+                                     f"WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+            for idx, page_content, metadata in rows:
+                documents[idx] = Document(page_content=page_content, metadata=json.loads(metadata))
+        return documents
+
+    def documents(self):
+        from langchain_core.documents import Document
+
+        if self.docs is not None:
+            return [self.docs[idx] for idx in self.ordered_ids().tolist()]
+        return [Document(page_content=page_content, metadata=json.loads(metadata)) for page_content, metadata
+                in self.conn.execute("SELECT page_content, metadata FROM documents ORDER BY id")]
+
+    def term_counts(self):
+        # term frequencies of every document, in the order of documents()
+        if self.docs is not None:
+            return [self.doc_terms[idx] for idx in self.ordered_ids().tolist()]
+        doc_terms = [{} for _ in range(self.ntotal)]
+        if self.has_terms:
+            for term, idx, tf in self.conn.execute("SELECT term, id, tf FROM terms"):
+                doc_terms[idx][term] = tf
+        return doc_terms
+
+    def lexical_statistics(self, live_files):
+        # number and total length of the documents of live files
+        if self.docs is not None:
+            return len(self.doc_terms), sum(sum(terms.values()) for terms in self.doc_terms.values())
+        if self.file_stats is None:
+            self.file_stats = {file_name: (count, length) for file_name, count, length in self.conn.execute(
+                "SELECT file_name, COUNT(*), SUM(length) FROM documents GROUP BY file_name")} \
+                if self.has_terms else {}
+        count, length = 0, 0
+        for file_name, (file_count, file_length) in self.file_stats.items():
+            if live_files.get(file_name) == self.segment_id:
+                count += file_count
+                length += file_length
+        return count, length
+
+    def postings(self, terms, live_files):
+        # term -> [(vector id, tf, document length)] for documents of live files
+        postings = {term: [] for term in terms}
+        if self.docs is not None:
+            for idx, doc_terms in self.doc_terms.items():
+                for term in terms:
+                    if term in doc_terms:
+                        postings[term].append((idx, doc_terms[term], sum(doc_terms.values())))
+            return postings
+        if not self.has_terms or not terms:
+            return postings
+        self.search_parameters(live_files)
+        dead_files = self.excluded[0]
+        rows = self.conn.execute(f"SELECT terms.term, terms.id, terms.tf, documents.length, documents.file_name "
+                                 f"FROM terms JOIN documents ON terms.id = documents.id "
+                                 f"WHERE terms.term IN ({','.join('?' * len(terms))})", list(terms))
+        for term, idx, tf, length, file_name in rows:
+            if file_name not in dead_files:
+                postings[term].append((idx, tf, length))
+        return postings
+
+    def exact_vectors(self, embeddings_model=None):
+        if self.docs is not None:
+            return reconstruct_vectors(faiss.downcast_index(self.index.index))
+        if self.compression == 'none':
+            return reconstruct_vectors(self.index)
+        # compressed codes are lossy, recover full precision vectors from the embedding cache
+        return normalize(embeddings_model.embed_documents([doc.page_content for doc in self.documents()]))
+
+    def search_parameters(self, live_files):
+        # vectors of files removed or re-indexed in another segment are excluded from the search
+        dead_files = frozenset(file_name for file_name in self.files if live_files.get(file_name) != self.segment_id)
+        if dead_files != self.excluded[0]:
+            if dead_files:
+                params, selectors = search_parameters(self.index, self.index_type, self.file_vector_ids(dead_files))
+            else:
+                params, selectors = None, None
+            self.excluded = (dead_files, params, selectors)
+        return self.excluded[1]
+
+    def search(self, embedding, k, live_files, file_names=None):
+        if file_names is None:
+            params = self.search_parameters(live_files)
+        elif self.index_type == 'flat':
+            # second retrieval stage, only the snippets of the given files are searched
+            params, selectors = search_parameters(self.index, self.index_type,
+                                                  included_ids=self.file_vector_ids(file_names))
+        else:
+            # hnsw and ivf only visit part of the vectors, the few snippets of the given files are scored exactly
+            return self.search_ids(embedding, k, self.file_vector_ids(file_names), live_files)
+        fetch_k, search_params = k, params
+        while True:
+            scores, ids = self.index.search(embedding, min(fetch_k, self.ntotal), params=search_params)
+            candidates = [(idx, score) for idx, score in zip(ids[0], scores[0]) if idx != -1]
+            # only the documents of returned candidates are read
+            documents = self.get_documents([idx for idx, _ in candidates])
+            docs = [((self.segment_id, idx), documents[idx], float(score)) for idx, score in candidates
+                    if live_files.get(documents[idx].metadata['file_name']) == self.segment_id
+                    and (file_names is None or documents[idx].metadata['file_name'] in file_names)]
+            # a selector is exact on flat indexes. indexes without selector support are filtered here and
+            # approximate ones can miss selected vectors, both fetch more candidates when needed
+            if len(docs) >= k or (params is not None and self.index_type == 'flat') or fetch_k >= self.ntotal:
+                return docs[:k]
+            fetch_k *= FETCH_FACTOR
+            if params is not None:
+                search_params = widened_parameters(params, self.index_type, fetch_k // k)
+
+    def search_ids(self, embedding, k, ids, live_files):
+        # exact scores of the vectors with the given ids, the k best of live files
+        if not ids:
+            return []
+        with self.lock:
+            vectors = reconstruct_ids(self.index, ids)
+        scores = vectors @ embedding[0]
+        top = [ids[i] for i in np.argsort(-scores)[:k]]
+        documents = self.get_documents(top)
+        score_of = dict(zip(ids, scores))
+        return [((self.segment_id, idx), documents[idx], float(score_of[idx])) for idx in top
+                if live_files.get(documents[idx].metadata['file_name']) == self.segment_id]
+
+    def search_files(self, embedding, n, live_files):
+        # first retrieval stage, returns [(file name, score)] of the closest live files
+        if self.docs is not None:
+            docs = self.documents()
+            self.file_names = sorted(self.files)
+            file_index = build_index(group_vectors(self.exact_vectors(), [doc.metadata['file_name'] for doc in docs],
+                                                   self.file_names), self.index.d)
+        elif self.file_index is not None:
+            file_index = self.file_index
+        else:
+            return None
+        fetch_n = n
+        while True:
+            scores, ids = file_index.search(embedding, min(fetch_n, len(self.file_names)))
+            files = [(self.file_names[idx], float(score)) for idx, score in zip(ids[0], scores[0])
+                     if idx != -1 and live_files.get(self.file_names[idx]) == self.segment_id]
+            if len(files) >= n or fetch_n >= len(self.file_names):
+                return files[:n]
+            fetch_n *= FETCH_FACTOR
+
 
 class VectorStore:
-    def __init__(self, embeddings_model, project_name, sha, update_from_sha=None):
-        self.db = None
-        self.embeddings_model = embeddings_model
-        self.create_dir()
+    def __init__(self, embeddings_model, project_name, sha, update_from_sha=None, index_type='auto',
+                 compression='none'):
+        # requested index type, 'auto' picks one from the segment size when saving
+        self.index_type = index_type
+        self.compression = compression
+        self.embeddings_model = embeddings_model if isinstance(embeddings_model, CachedEmbeddings) \
+            else CachedEmbeddings(embeddings_model)
         self.project_name = project_name
         self.sha = sha
         self.update_from_sha = update_from_sha
+        # saved segments referenced by the snapshot and the segment collecting new documents
+        self.segments = {}
+        self.new_segment = None
+        # live file name -> id of the segment holding its documents
+        self.files = {}
+        self.dim = None
+        # documents waiting to be embedded in one batch
+        self.pending_docs = []
+        self.create_dir()
 
     def create_dir(self):
-        if not os.path.exists(VECTORSTORE):
-            # create if dir does not exist
-            os.makedirs(VECTORSTORE)
+        if not os.path.exists(project_dir(self.project_name)):
+            # create if dir does not exist, stores of several commits may be created at once
+            os.makedirs(os.path.join(project_dir(self.project_name), 'segments'), exist_ok=True)
+            os.makedirs(os.path.join(project_dir(self.project_name), 'manifests'), exist_ok=True)
             print('Vector Database directory created successfully')
 
-    def read_index(self):
-        if os.path.exists(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.json')):
-            with open(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.json'), 'r') as f:
-                index_dict = json.load(f)
-        elif self.update_from_sha \
-                and os.path.exists(os.path.join(VECTORSTORE, f'{self.project_name}_{self.update_from_sha}.json')):
-            with open(os.path.join(VECTORSTORE, f'{self.project_name}_{self.update_from_sha}.json'), 'r') as f:
-                index_dict = json.load(f)
-        else:
-            index_dict = {}
-        return index_dict
+    def read_manifest(self, sha):
+        path = manifest_path(self.project_name, sha)
+        if not sha or not os.path.isfile(path):
+            return None
+        with open(path, 'r') as f:
+            manifest = json.load(f)
+        # file mtime is the last use of the snapshot for retention
+        os.utime(path)
+        return manifest
 
-    def write_index(self, index_dict):
-        with open(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.json'), 'w') as f:
-            json.dump(index_dict, f)
+    def write_manifest(self):
+        write_json(manifest_path(self.project_name, self.sha), {"sha": self.sha,
+                                                                "dim": self.dim,
+                                                                "segments": sorted(self.segments),
+                                                                "files": self.files})
 
-    def add_documents(self, docs):
-        # read last index in file
-        index_dict = self.read_index()
-        # create ids by file names in metadata
-        ids = []
+    def load_manifest(self, manifest):
+        self.dim = manifest["dim"]
+        self.files = manifest["files"]
+        self.segments = {segment_id: Segment.load(self.project_name, segment_id)
+                         for segment_id in manifest["segments"]}
+
+    def add_documents(self, docs, lexical_texts=None):
+        # lexical_texts are indexed for keyword retrieval, like the snippet source and class name of a summary
+        if lexical_texts is None:
+            lexical_texts = [doc.page_content for doc in docs]
         for doc in docs:
             file_name = doc.metadata['file_name']
-            last_index = index_dict.get(file_name, -1)
-            doc_id = file_name + '-' + str(last_index + 1)
-            index_dict[file_name] = last_index + 1
-            ids.append(doc_id)
-        self.db.add_documents(documents=docs, ids=ids)
-        # record last index
-        self.write_index(index_dict)
+            # documents of a file in an older segment are shadowed by the new ones
+            self.files[file_name] = self.new_segment.segment_id
+        self.pending_docs.extend(zip(docs, lexical_texts))
+        if len(self.pending_docs) >= EMBED_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.pending_docs:
+            return
+        texts = [doc.page_content for doc, _ in self.pending_docs]
+        # normalized so that inner product is cosine similarity
+        embeddings = normalize(self.embeddings_model.embed_documents(texts))
+        self.new_segment.add_embeddings(texts, embeddings, [doc.metadata for doc, _ in self.pending_docs],
+                                        [lexical_text for _, lexical_text in self.pending_docs])
+        self.pending_docs = []
 
     def remove_documents(self, file_names):
-        index_dict = self.read_index()
+        # saved segments are shared, removing only drops the files from this snapshot
+        self.flush()
+        new_files = [file_name for file_name in file_names if self.files.get(file_name) == self.new_segment.segment_id]
+        self.new_segment.delete_files(new_files)
         for file_name in file_names:
-            last_index = index_dict.get(file_name, -1)
-            if last_index != -1:
-                result = self.db.delete([file_name + '-' + str(idx) for idx in range(last_index+1)])
-                if result:
-                    # print(f"File {file_name} documents removed successfully")
-                    index_dict.pop(file_name)
-                else:
-                    print(f"File {file_name} documents fail to be removed")
-        self.write_index(index_dict)
-
-    def match_documents(self, instruction):
-        retriever = self.db.as_retriever()
-        matched_docs = retriever.invoke(instruction)
+            self.files.pop(file_name, None)
+
+    def vector_search(self, instruction, k=4, top_files=None):
+        # with top_files, the closest files are found on the file level index first and only their
+        # snippets are searched
+        embedding = normalize([self.embeddings_model.embed_query(instruction)])
+        segments = self.all_segments()
+        if not top_files:
+            results = []
+            for segment in segments:
+                results.extend(segment.search(embedding, k, self.files))
+            results.sort(key=lambda x: x[2], reverse=True)
+            return results[:k]
+
+        file_results, snippet_segments = [], []
+        for segment in segments:
+            files = segment.search_files(embedding, top_files, self.files)
+            if files is None:
+                snippet_segments.append(segment)
+            else:
+                file_results.extend((score, file_name, segment) for file_name, score in files)
+        file_results.sort(key=lambda x: x[0], reverse=True)
+        segment_files = {}
+        for _, file_name, segment in file_results[:top_files]:
+            segment_files.setdefault(segment, set()).add(file_name)
+        results = []
+        for segment, file_names in segment_files.items():
+            results.extend(segment.search(embedding, k, self.files, file_names))
+        for segment in snippet_segments:
+            results.extend(segment.search(embedding, k, self.files))
+        results.sort(key=lambda x: x[2], reverse=True)
+        # the best snippets of each file come before further snippets of files already matched
+        file_ranks = {}
+        ranks = []
+        for result in results:
+            file_name = result[1].metadata['file_name']
+            ranks.append(file_ranks.get(file_name, 0) // SNIPPETS_PER_FILE)
+            file_ranks[file_name] = file_ranks.get(file_name, 0) + 1
+        order = sorted(range(len(results)), key=lambda i: (ranks[i], -results[i][2]))
+        return [results[i] for i in order[:k]]
+
+    def lexical_search(self, instruction, k=4):
+        # bm25 over snippet terms, statistics are computed over the live documents of all segments
+        terms = set(tokenize(instruction))
+        if not terms:
+            return []
+        segments = self.all_segments()
+        num_docs, total_length = 0, 0
+        segment_postings = []
+        df = {term: 0 for term in terms}
+        for segment in segments:
+            count, length = segment.lexical_statistics(self.files)
+            num_docs += count
+            total_length += length
+            postings = segment.postings(terms, self.files)
+            for term, entries in postings.items():
+                df[term] += len(entries)
+            segment_postings.append((segment, postings))
+        if not num_docs:
+            return []
+        avg_length = total_length / num_docs
+        scores = {}
+        for segment, postings in segment_postings:
+            for term, entries in postings.items():
+                for idx, tf, length in entries:
+                    key = (segment, idx)
+                    scores[key] = scores.get(key, 0.0) + bm25_score(tf, df[term], length, num_docs, avg_length)
+        top = sorted(scores, key=lambda key: scores[key], reverse=True)[:k]
+        results = []
+        for segment, idx in top:
+            doc = segment.get_documents([idx])[idx]
+            results.append(((segment.segment_id, idx), doc, scores[(segment, idx)]))
+        return results
+
+    def match_documents(self, instruction, k=4, hybrid=True, top_files=TOP_FILES):
+        self.flush()
+        if not hybrid:
+            return [doc for _, doc, _ in self.vector_search(instruction, k, top_files)]
+        # reciprocal rank fusion of the embedding and keyword rankings
+        candidates = max(k, HYBRID_CANDIDATES)
+        vector_results = self.vector_search(instruction, candidates, top_files)
+        lexical_results = self.lexical_search(instruction, candidates)
+        docs = {key: doc for key, doc, _ in vector_results + lexical_results}
+        fused = reciprocal_rank_fusion([[key for key, _, _ in vector_results], [key for key, _, _ in lexical_results]])
+        matched_docs = [docs[key] for key in fused[:k]]
         return matched_docs
 
+    def all_segments(self):
+        segments = list(self.segments.values())
+        if self.new_segment and self.new_segment.ntotal:
+            segments.append(self.new_segment)
+        return segments
+
     def load_db(self):
-        if os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.faiss')) \
-                and os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.pkl')) \
-                and os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.json')):
-            self.db = FAISS.load_local(VECTORSTORE, self.embeddings_model, f"{self.project_name}_{self.sha}",
-                                       allow_dangerous_deserialization=True)
+        manifest = self.read_manifest(self.sha)
+        if manifest:
+            self.load_manifest(manifest)
+            status = 1
             print("Vector database loaded successfully.")
-            return 1
-        elif os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.update_from_sha}.faiss')) \
-                and os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.update_from_sha}.pkl')) \
-                and os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.update_from_sha}.json')):
-            self.db = FAISS.load_local(VECTORSTORE, self.embeddings_model,
-                                       f"{self.project_name}_{self.update_from_sha}",
-                                       allow_dangerous_deserialization=True)
-            print("Vector database from another commit loaded successfully.")
-            return 2
         else:
-            self.db = FAISS(
-                embedding_function=self.embeddings_model,
-                index=faiss.IndexFlatIP(len(self.embeddings_model.embed_query("faiss"))),
-                docstore=InMemoryDocstore(),
-                index_to_docstore_id={},
-            )
-            print("No current vector database found, new one created.")
-            return 0
+            manifest = self.read_manifest(self.update_from_sha)
+            if manifest:
+                self.load_manifest(manifest)
+                status = 2
+                print("Vector database from another commit loaded successfully.")
+            else:
+                status = 0
+                print("No current vector database found, new one created.")
+        self.new_segment = Segment.create(self.dim)
+        return status
 
     def load_refreshed_db(self):
-        if os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.faiss')):
-            os.remove(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.faiss'))
-        if os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.pkl')):
-            os.remove(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.pkl'))
-        if os.path.isfile(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.json')):
-            os.remove(os.path.join(VECTORSTORE, f'{self.project_name}_{self.sha}.json'))
-        self.db = FAISS(
-                embedding_function=self.embeddings_model,
-                index=faiss.IndexFlatIP(len(self.embeddings_model.embed_query("faiss"))),
-                docstore=InMemoryDocstore(),
-                index_to_docstore_id={},
-            )
+        # segments of the old snapshot are left to garbage collection
+        if os.path.isfile(manifest_path(self.project_name, self.sha)):
+            os.remove(manifest_path(self.project_name, self.sha))
+        self.dim = None
+        self.segments, self.files = {}, {}
+        self.new_segment = Segment.create(self.dim)
         print("Vector store refreshed and created successfully.")
 
+    def live_ratio(self):
+        # share of files in the saved segments that are still live in this snapshot
+        total = sum(len(segment.files) for segment in self.segments.values())
+        if not total:
+            return 1.0
+        live = sum(1 for segment in self.segments.values() for file_name in segment.files
+                   if self.files.get(file_name) == segment.segment_id)
+        return live / total
+
+    def compact(self):
+        # merge the live documents of all segments into the new segment
+        texts, vectors, metadatas, doc_terms = [], [], [], []
+        for segment in self.segments.values():
+            segment_vectors = segment.exact_vectors(self.embeddings_model)
+            for doc, vector, terms in zip(segment.documents(), segment_vectors, segment.term_counts()):
+                if self.files.get(doc.metadata['file_name']) == segment.segment_id:
+                    texts.append(doc.page_content)
+                    vectors.append(vector)
+                    metadatas.append(doc.metadata)
+                    doc_terms.append(terms)
+        if texts:
+            self.new_segment.add_embeddings(texts, np.stack(vectors), metadatas, doc_terms)
+        for file_name in self.files:
+            self.files[file_name] = self.new_segment.segment_id
+        print(f"Vector database compacted {len(self.segments)} segments into one with {len(texts)} documents.")
+        self.segments = {}
+
     def save_db(self):
-        self.db.save_local(VECTORSTORE, f"{self.project_name}_{self.sha}")
-        print("Vector database saved successfully")
\ No newline at end of file
+        start_time = time.time()
+        self.flush()
+        print("Embedding cache:", self.embeddings_model.cache.stats())
+        self.embeddings_model.cache.evict()
+        # drop segments no live file points to any more
+        live_segments = set(self.files.values())
+        self.segments = {segment_id: segment for segment_id, segment in self.segments.items()
+                         if segment_id in live_segments}
+        if len(self.segments) >= MAX_SEGMENTS or self.live_ratio() < 1 - MAX_DEAD_RATIO:
+            self.compact()
+        if self.new_segment.ntotal:
+            self.dim = self.new_segment.index.d
+            self.new_segment.save(self.project_name, self.index_type, self.compression)
+            self.segments[self.new_segment.segment_id] = self.new_segment
+            self.new_segment = Segment.create(self.dim)
+        self.write_manifest()
+        print(f"Vector database saved successfully in {time.time() - start_time:.3f}s")
+
+
+def collect_garbage(max_bytes, project_name=None):
+    # evict least recently used snapshots until the referenced segments fit in max_bytes,
+    # then delete segments no remaining snapshot references
+    project_names = [project_name] if project_name else [name for name in os.listdir(VECTORSTORE)
+                                                         if os.path.isdir(os.path.join(VECTORSTORE, name, 'manifests'))]
+    manifests = []
+    segment_sizes = {}
+    for name in project_names:
+        manifest_dir = os.path.join(project_dir(name), 'manifests')
+        for file in os.listdir(manifest_dir):
+            if not file.endswith('.json'):
+                continue
+            path = os.path.join(manifest_dir, file)
+            with open(path, 'r') as f:
+                segments = [(name, segment_id) for segment_id in json.load(f)["segments"]]
+            manifests.append((os.path.getmtime(path), path, segments))
+        for segment_id in os.listdir(os.path.join(project_dir(name), 'segments')):
+            segment_sizes[(name, segment_id)] = dir_size(segment_dir(name, segment_id))
+    manifests.sort()
+
+    referenced = {}
+    for _, _, segments in manifests:
+        for segment in segments:
+            referenced[segment] = referenced.get(segment, 0) + 1
+    total = sum(segment_sizes.get(segment, 0) for segment in referenced)
+    removed_manifests = 0
+    for _, path, segments in manifests:
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        removed_manifests += 1
+        for segment in segments:
+            referenced[segment] -= 1
+            if not referenced[segment]:
+                total -= segment_sizes.get(segment, 0)
+
+    freed = 0
+    for segment, size in segment_sizes.items():
+        # segments younger than a minute may belong to a snapshot that is being saved
+        if not referenced.get(segment) and time.time() - os.path.getmtime(segment_dir(*segment)) > 60:
+            shutil.rmtree(segment_dir(*segment))
+            freed += size
+    print(f"Removed {removed_manifests} snapshots and freed {freed / 1024 / 1024:.1f} MB, "
+          f"{total / 1024 / 1024:.1f} MB in use.")
+    return removed_manifests, freed
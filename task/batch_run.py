@@ -0,0 +1,339 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+current_path = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root)
+
+from task.run_command import git_clone_repo
+from task.run_task import LLMCodeGenerator, CommitIndexer, index_commit, patch_instruction, vector_store_name, \
+    create_embeddings_model, EMBEDDING_MODEL, HOME, PARSE_WORKERS, SUFFIX
+from task.worktree_pool import WorktreePool
+from model.summarizer import MAX_CONCURRENCY
+from model.embeddings import CachedEmbeddings
+from model.context_builder import CONTEXT_TOKEN_BUDGET
+
+# instructions patched at the same time, each in its own worktree
+BATCH_WORKERS = 4
+CHECKPOINT_FILE = 'batch_checkpoint.jsonl'
+REPO_TYPES = ('local', 'github')
+
+
+def read_requests(request_file, repo=None, repo_type='local', language=None, commit_sha=None):
+    # one instruction per line. missing fields fall back to the given defaults, the instruction is
+    # user_instruction, problem_statement or title and body like the entries of requests.jsonl
+    requests = []
+    with open(request_file, 'r', encoding='utf-8') as file:
+        for idx, line in enumerate(file):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            instruction = item.get('user_instruction') or item.get('problem_statement') or \
+                '\n\n'.join(part for part in (item.get('title'), item.get('body')) if part)
+            requests.append({"request_id": str(item.get('request_id') or item.get('instance_id') or idx),
+                             "repo": item.get('repo') or repo,
+                             "repo_type": item.get('repo_type') or repo_type,
+                             "language": item.get('language') or language,
+                             "commit_sha": item.get('commit_sha') or item.get('base_commit') or commit_sha,
+                             "user_instruction": instruction})
+    return requests
+
+
+def request_error(request):
+    # reason a request can never run, None when it is complete
+    if not request["repo"]:
+        return "no repo"
+    if request["repo_type"] not in REPO_TYPES:
+        return f"unsupported repo type {request['repo_type']}"
+    if request["repo_type"] == 'github' and '/' not in request["repo"]:
+        return f"github repo {request['repo']} is not named owner/name"
+    if request["language"] not in SUFFIX:
+        return f"unsupported language {request['language']}"
+    if not request["user_instruction"].strip():
+        return "no instruction"
+    return None
+
+
+def retryable(error):
+    # network, rate limit and api key errors may be gone when the batch is resumed, other errors fail the same
+    # way on every run
+    from model.connect import TRANSIENT_ERRORS, ACCOUNT_ERRORS
+
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, TRANSIENT_ERRORS + ACCOUNT_ERRORS + (ConnectionError, TimeoutError)):
+            return True
+        seen.add(id(error))
+        error = error.__cause__ or error.__context__
+    return False
+
+
+def read_checkpoint(checkpoint):
+    # request id -> log of the requests finished by earlier runs
+    done = {}
+    if os.path.isfile(checkpoint):
+        with open(checkpoint, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    log_info = json.loads(line)
+                except json.JSONDecodeError:
+                    # last line of an interrupted run
+                    continue
+                done[log_info["request_id"]] = log_info
+    return done
+
+
+class SharedVectorStore:
+    # one loaded snapshot used by every request of a commit, queries of concurrent requests take turns
+    def __init__(self, vector_store):
+        self.vector_store = vector_store
+        self.lock = threading.Lock()
+
+    def match_documents(self, *args, **kwargs):
+        with self.lock:
+            return self.vector_store.match_documents(*args, **kwargs)
+
+
+class BatchRunner:
+    def __init__(self, home_path, model_name, log_dir, checkpoint=None, workers=BATCH_WORKERS, index_workers=1,
+                 token_budget=CONTEXT_TOKEN_BUDGET, include_globs=None, exclude_globs=None, keep_generated=False,
+                 **index_kwargs):
+        # index_kwargs are passed to set_vector_store when a commit is indexed
+        self.home_path = home_path
+        self.model_name = model_name
+        self.checkpoint = checkpoint or os.path.join(log_dir, CHECKPOINT_FILE)
+        self.workers = max(1, workers)
+        self.index_workers = index_workers
+        self.token_budget = token_budget
+        self.policy_kwargs = {"include_globs": include_globs, "exclude_globs": exclude_globs,
+                              "skip_generated": not keep_generated}
+        self.index_kwargs = index_kwargs
+        self.content = index_kwargs.get('content', 'summary')
+        self.embeddings_model = CachedEmbeddings(create_embeddings_model, model_name=EMBEDDING_MODEL)
+        self.checkpoint_lock = threading.Lock()
+        # per repo: project name, language, worktree pool and background indexer
+        self.projects = {}
+        # (repo, sha) -> [lock, shared store, requests left]
+        self.stores = {}
+        self.stores_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.checkpoint)), exist_ok=True)
+
+    def prepare_project(self, repo, repo_type, language):
+        if repo not in self.projects:
+            if repo_type == "github":
+                git_clone_repo(repo, False, self.home_path)
+                project_name = repo.split('/')[1]
+            else:
+                project_name = repo
+            project_path = os.path.join(self.home_path, project_name)
+            if not os.path.isdir(project_path):
+                raise ValueError(f"no repository {project_name} in {self.home_path}")
+            self.projects[repo] = {"project_name": project_name, "project_path": project_path,
+                                   "language": language, "pool": WorktreePool(project_path, self.workers)}
+        return self.projects[repo]
+
+    def resolve_sha(self, project, commit_sha):
+        return subprocess.run(["git", "rev-parse", "--verify", f"{commit_sha or 'HEAD'}^{{commit}}"],
+                              cwd=project["project_path"], capture_output=True, text=True, check=True).stdout.strip()
+
+    def acquire_store(self, repo, sha):
+        # the snapshot of a commit is loaded once and shared by its requests
+        with self.stores_lock:
+            entry = self.stores[(repo, sha)]
+        with entry[0]:
+            if entry[1] is None:
+                from model.vector_store import VectorStore
+
+                project = self.projects[repo]
+                project["indexer"].wait(sha)
+                store_name = vector_store_name(project["project_name"], self.content)
+                vector_store = VectorStore(self.embeddings_model, store_name, sha)
+                if vector_store.load_db() != 1:
+                    # indexing in the background failed, index here so the error is raised for this request
+                    index_commit(project["language"], project["project_name"], self.home_path, sha,
+                                 self.model_name, **self.policy_kwargs, **self.index_kwargs)
+                    vector_store.load_db()
+                entry[1] = SharedVectorStore(vector_store)
+            return entry[1]
+
+    def release_store(self, repo, sha):
+        with self.stores_lock:
+            entry = self.stores[(repo, sha)]
+            entry[2] -= 1
+            if not entry[2]:
+                # no request of the commit is left
+                entry[1] = None
+
+    def run_request(self, request, sha):
+        start_time = datetime.datetime.now()
+        repo = request["repo"]
+        project = self.projects[repo]
+        try:
+            vector_store = self.acquire_store(repo, sha)
+            with project["pool"].lease(sha) as work_path:
+                generator = LLMCodeGenerator(language=project["language"], project_name=project["project_name"],
+                                             project_path=self.home_path, user_instruction=request["user_instruction"],
+                                             sha=sha, model_name=self.model_name, work_path=work_path,
+                                             **self.policy_kwargs)
+                generator.vector_store = vector_store
+                log_info = patch_instruction(generator, repo, request["repo_type"], project["language"], sha,
+                                             self.model_name, self.token_budget, start_time)
+        finally:
+            self.release_store(repo, sha)
+        log_info["request_id"] = request["request_id"]
+        self.write_checkpoint(log_info)
+        return log_info
+
+    def write_checkpoint(self, log_info):
+        with self.checkpoint_lock:
+            with open(self.checkpoint, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(log_info) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def fail_request(self, request, error):
+        # a request that fails on every run is checkpointed as failed like a patch that did not apply, the
+        # others are left out of the checkpoint and run again when the batch is resumed
+        print(f"ERROR in request {request['request_id']}:", error)
+        if retryable(error):
+            return None
+        log_info = {"request_id": request["request_id"], "repo": request["repo"], "repo_type": request["repo_type"],
+                    "language": request["language"], "commit_sha": request["commit_sha"], "success": False,
+                    "log_message": f"{type(error).__name__}: {error}"}
+        self.write_checkpoint(log_info)
+        return log_info
+
+    def run(self, requests):
+        done = read_checkpoint(self.checkpoint)
+        pending = [request for request in requests if request["request_id"] not in done]
+        print(f"{len(requests) - len(pending)} requests finished before, {len(pending)} to run.")
+        results = dict(done)
+        failed = 0
+        # requests of one commit run next to each other so its snapshot is loaded once
+        groups = {}
+        for request in pending:
+            # a failing request only fails itself, the others of its repo or commit still run
+            error = request_error(request)
+            if error:
+                results[request["request_id"]] = self.fail_request(request, ValueError(error))
+                failed += 1
+                continue
+            try:
+                project = self.prepare_project(request["repo"], request["repo_type"], request["language"])
+            except ValueError as e:
+                results[request["request_id"]] = self.fail_request(request, e)
+                failed += 1
+                continue
+            except Exception as e:
+                # a clone that failed is retried when the batch is resumed
+                print(f"ERROR in request {request['request_id']}:", e)
+                failed += 1
+                continue
+            try:
+                sha = self.resolve_sha(project, request["commit_sha"])
+            except subprocess.CalledProcessError as e:
+                # a commit the clone does not have
+                results[request["request_id"]] = self.fail_request(
+                    request, ValueError(f"unknown revision {request['commit_sha']}: {e.stderr.strip()}"))
+                failed += 1
+                continue
+            except Exception as e:
+                print(f"ERROR in request {request['request_id']}:", e)
+                failed += 1
+                continue
+            groups.setdefault((request["repo"], sha), []).append(request)
+        for (repo, sha), group in groups.items():
+            self.stores[(repo, sha)] = [threading.Lock(), None, len(group)]
+        indexers = []
+        for repo, project in self.projects.items():
+            # upcoming commits are indexed while the requests of earlier ones are patched
+            project["indexer"] = CommitIndexer(project["language"], project["project_name"], self.home_path,
+                                               [sha for group_repo, sha in groups if group_repo == repo],
+                                               workers=self.index_workers, model_name=self.model_name,
+                                               **self.policy_kwargs, **self.index_kwargs)
+            indexers.append(project["indexer"])
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self.run_request, request, sha): request
+                           for (repo, sha), group in groups.items() for request in group}
+                for future in as_completed(futures):
+                    request = futures[future]
+                    try:
+                        results[request["request_id"]] = future.result()
+                    except Exception as e:
+                        failed += 1
+                        log_info = self.fail_request(request, e)
+                        if log_info:
+                            results[request["request_id"]] = log_info
+        finally:
+            for indexer in indexers:
+                indexer.close()
+        print(f"{len(results)} of {len(requests)} requests finished, {failed} failed. Logs in {self.checkpoint}")
+        return results
+
+
+def main(request_file, home_path, repo, repo_type, language, commit_sha, model_name, log_dir, checkpoint=None,
+         workers=BATCH_WORKERS, index_workers=1, max_concurrency=MAX_CONCURRENCY, tokens_per_minute=None,
+         index_type='auto', compression='none', token_budget=CONTEXT_TOKEN_BUDGET, content='summary',
+         parse_workers=PARSE_WORKERS, include_globs=None, exclude_globs=None, keep_generated=False):
+    requests = read_requests(request_file, repo, repo_type, language, commit_sha)
+    runner = BatchRunner(home_path, model_name, log_dir, checkpoint, workers, index_workers, token_budget,
+                         include_globs, exclude_globs, keep_generated, max_concurrency=max_concurrency,
+                         tokens_per_minute=tokens_per_minute, index_type=index_type, compression=compression,
+                         content=content, parse_workers=parse_workers)
+    return runner.run(requests)
+
+
+if __name__ == "__main__":
+    from model.index_factory import INDEX_TYPES, COMPRESSIONS
+
+    parser = ArgumentParser()
+    parser.add_argument("--request_file", type=str, required=True,
+                        help="JSONL of instructions with request_id, user_instruction (or title and body) and "
+                             "optionally repo, repo_type, language and commit_sha.")
+    parser.add_argument("--repo", type=str, default=None, help="Repository of requests that name none.")
+    parser.add_argument("--repo_type", type=str, default='local', choices=["local", "github"],
+                        help="Whether the repository of requests that name none is a local or github repo")
+    parser.add_argument("--language", type=str, default=None, choices=["flutter", "python"],
+                        help="Language of requests that name none.")
+    parser.add_argument("--commit_sha", type=str, default=None,
+                        help="Commit of requests that name none. Use the latest commit as default")
+    parser.add_argument("--model_name", type=str, default="gpt-4o", help="Model name of Openai LLM API.")
+    parser.add_argument("--home_path", type=str, default=HOME, help="Path to the repo. Use home directory as default.")
+    parser.add_argument("--log_dir", type=str, default=os.path.join(root, 'log'), help="Full path to the log dir.")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="JSONL the log of every finished request is appended to, finished requests are "
+                             "skipped when the batch is run again. Use batch_checkpoint.jsonl in log_dir as default.")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS,
+                        help="Requests patched at the same time, each in its own git worktree.")
+    parser.add_argument("--index_workers", type=int, default=1,
+                        help="Commits indexed at the same time in the background.")
+    parser.add_argument("--max_concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="Maximum number of code summary requests in flight when building the vector store.")
+    parser.add_argument("--tokens_per_minute", type=int, default=None,
+                        help="Token per minute budget of code summary requests. 150000 as default when requests "
+                             "run concurrently, 0 disables the limit.")
+    parser.add_argument("--index_type", type=str, default='auto', choices=list(INDEX_TYPES),
+                        help="Vector index type. 'auto' selects flat, hnsw or ivf by corpus size.")
+    parser.add_argument("--compression", type=str, default='none', choices=list(COMPRESSIONS),
+                        help="Encoding of stored vectors.")
+    parser.add_argument("--token_budget", type=int, default=CONTEXT_TOKEN_BUDGET,
+                        help="Prompt tokens of retrieved code context packed from the matched snippets.")
+    parser.add_argument("--content", type=str, default='summary', choices=['summary', 'code'],
+                        help="Embed llm summaries of the code snippets or the raw snippets.")
+    parser.add_argument("--parse_workers", type=int, default=PARSE_WORKERS,
+                        help="Processes parsing code files while indexing. Use the number of cores as default.")
+    parser.add_argument("--include_globs", type=str, nargs='*', default=None,
+                        help="Only index code files whose path relative to the repo matches one of these globs.")
+    parser.add_argument("--exclude_globs", type=str, nargs='*', default=None,
+                        help="Skip code files matching these globs, in addition to build output and vendored "
+                             "packages.")
+    parser.add_argument("--keep_generated", action='store_true',
+                        help="Also index generated code files like *.g.dart and files with a generated header.")
+    args = parser.parse_args()
+    main(**vars(args))
@@ -3,14 +3,14 @@ import subprocess
 
 HOME = os.getenv('HOME')
 
-def git_clone_repo(repo, overwrite=False):
-    os.chdir(HOME)
+def git_clone_repo(repo, overwrite=False, home_path=HOME):
+    # clone into home_path, the directory the project is read from
     proj = '/'.join(repo.split('/')[1:])
     # git clone
-    if not os.path.exists(proj):
-        subprocess.run(["git", "clone", f"https://github.com/{repo}.git", proj], check=True)
+    if not os.path.exists(os.path.join(home_path, proj)):
+        subprocess.run(["git", "clone", f"https://github.com/{repo}.git", proj], cwd=home_path, check=True)
     else:
         if overwrite:
-            subprocess.run(["rm", "-rf", proj], check=True)
-            subprocess.run(["git", "clone", f"https://github.com/{repo}.git", proj], check=True)
+            subprocess.run(["rm", "-rf", proj], cwd=home_path, check=True)
+            subprocess.run(["git", "clone", f"https://github.com/{repo}.git", proj], cwd=home_path, check=True)
     print(f"Repo {repo} cloned successfully")
\ No newline at end of file
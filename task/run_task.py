@@ -1,125 +1,281 @@
 import datetime
 import json
+import multiprocessing
 import os
 import re
 import subprocess
 import sys
+import threading
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    # not available on windows, a commit is then only locked within one process
+    fcntl = None
 current_path = os.path.abspath(__file__)
 root = os.path.dirname(os.path.dirname(current_path))
 sys.path.append(root)
 
 from tqdm import tqdm
 
-from langchain_core.documents import Document
-
-from model.connect import Openai
-from model.output_parser import FileOutputParser
-from model.prompt import prompt_list_for_position_and_patch, prompt_list_for_summarize_code, \
-    prompt_list_for_process_instruction
+from model.prompt import prompt_list_for_position_and_patch, prompt_list_for_process_instruction, \
+    SUMMARIZE_PROMPT_VERSION
 from task.run_command import git_clone_repo
-from utils.code_parser import get_code_parser
-from model.vector_store import VectorStore
-from dotenv import load_dotenv
-
-load_dotenv()
+from utils.code_parser import get_code_parser, parse_code_files, decode_source, PARSER_VERSION
+from utils.git_objects import GitObjectReader
+from utils.indexing_policy import IndexingPolicy, file_hash
+from model.summarizer import CodeSummarizer, MAX_CONCURRENCY
+from model.cache import SummaryCache, SnippetCache, SQL_BATCH
+from model.embeddings import CachedEmbeddings
+from model.context_builder import ContextBuilder, CONTEXT_TOKEN_BUDGET, CONTEXT_CANDIDATES
 
-OPENAI_API_KEY = os.getenv('API_KEY')
-if OPENAI_API_KEY is None:
-    raise ValueError("API_KEY environment variable is not set.")
+# langchain, openai, faiss and dotenv are imported on first use so that runs served from the local
+# vector store and caches start without loading them or touching the network
 
 RETRY_WAIT_TIME = 30
 MAX_RETRY = 5
 SUFFIX = {"flutter": ".dart",
           "python": ".py"}
 HOME = os.getenv('HOME')
+# default model of OpenAIEmbeddings, recorded so the embedding cache can be used before a client exists
+EMBEDDING_MODEL = "text-embedding-ada-002"
+PARSE_WORKERS = os.cpu_count() or 1
+# files parsed per worker task
+PARSE_BATCH = 16
+# parsing workers are started from a fresh interpreter, forking would copy the locks held by the summary, indexing
+# and git reader threads of this process
+PARSE_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+# ancestors searched for an indexed snapshot to update from
+BASE_SEARCH_DEPTH = 1000
+# most recently used snapshots of other branches compared by their number of changed files
+BASE_CANDIDATES = 8
+# commits indexed in the background beyond the one being patched
+INDEX_AHEAD = 2
+
+
+def vector_store_name(project_name, content='summary'):
+    return project_name if content == 'summary' else f'{project_name}-{content}'
+
+
+def get_api_key():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    api_key = os.getenv('API_KEY')
+    if api_key is None:
+        raise ValueError("API_KEY environment variable is not set.")
+    return api_key
 
-from langchain_openai import OpenAIEmbeddings
+
+def create_embeddings_model():
+    from langchain_openai import OpenAIEmbeddings
+
+    return OpenAIEmbeddings(model=EMBEDDING_MODEL, api_key=get_api_key())
 
 
 class LLMCodeGenerator:
-    def __init__(self, language, project_name, project_path, user_instruction, sha=None, model_name="gpt-4o-mini"):
+    def __init__(self, language, project_name, project_path, user_instruction, sha=None, model_name="gpt-4o-mini",
+                 include_globs=None, exclude_globs=None, skip_generated=True, checkout=True, work_path=None):
         self.language = language
         self.sha = sha
         self.project_name = project_name
-        self.project_path = os.path.join(project_path, project_name)
+        # vector stores name files by their path in the clone, work_path is a worktree of the clone that is
+        # checked out and patched instead, see task/worktree_pool.py
+        self.index_root = os.path.join(project_path, project_name)
+        self.project_path = work_path or self.index_root
         self.user_instruction = user_instruction
+        self.model_name = model_name
+        # without checkout, files of the commit are read from the git object database and the working tree is
+        # left untouched. such a generator only builds the vector store, patches need the checked out files
+        self.checkout = checkout
+        self._git_objects = None
         self.set_sha()
-        self.non_code_files, self.code_files = self.list_files()
+        self._files = None
+        self._code_files = None
+        self._indexed_files = None
+        self._file_blobs = None
+        # (commit1, commit2) -> changed code files
+        self._changed_files = {}
+        # which code files are summarized and embedded, all code files stay editable
+        self.indexing_policy = IndexingPolicy(language, self.project_path, include_globs, exclude_globs,
+                                              skip_generated, read_head=None if checkout else self.read_blob)
         self.file_codes = {}
         self.code_summary = {}
-        self.embeddings_model = OpenAIEmbeddings(
-            api_key=OPENAI_API_KEY
-        )
-        self.llm = Openai(api_key=OPENAI_API_KEY, model_name=model_name)
+        # openai clients are created on first use
+        self.embeddings_model = CachedEmbeddings(create_embeddings_model, model_name=EMBEDDING_MODEL)
+        self._llm = None
         self.vector_store = None
+        self.context_tokens = 0
 
         # process user instruction
         # self.process_user_instruction()
 
+    @property
+    def llm(self):
+        if self._llm is None:
+            from model.connect import Openai
+
+            self._llm = Openai(api_key=get_api_key(), model_name=self.model_name)
+        return self._llm
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._files = self.list_files()
+        return self._files
+
+    @property
+    def code_files(self):
+        # absolute path -> path relative to the project, a dict so that membership checks are constant time
+        if self._code_files is None:
+            suffix = SUFFIX[self.language]
+            self._code_files = {os.path.join(self.project_path, path): path for path in self.files
+                                if path.endswith(suffix)}
+        return self._code_files
+
+    @property
+    def non_code_files(self):
+        # built only when asked for
+        suffix = SUFFIX[self.language]
+        return [os.path.join(self.project_path, path) for path in self.files if not path.endswith(suffix)]
+
+    @property
+    def indexed_files(self):
+        if self._indexed_files is None:
+            self._indexed_files = self.indexing_policy.select(self.code_files)
+        return self._indexed_files
+
+    @property
+    def git_objects(self):
+        if self._git_objects is None:
+            self._git_objects = GitObjectReader(self.project_path)
+        return self._git_objects
+
+    def read_blob(self, file_name):
+        return self.git_objects.read(self.file_blobs[file_name]) or b''
+
+    @property
+    def file_blobs(self):
+        # absolute file path -> git blob sha of the files of the commit
+        if self._file_blobs is None:
+            result = subprocess.run(["git", "ls-tree", "-r", "-z", self.sha], cwd=self.project_path,
+                                    capture_output=True, text=True, check=True)
+            self._file_blobs = {}
+            for entry in result.stdout.split('\0'):
+                if entry:
+                    info, path = entry.split('\t', 1)
+                    self._file_blobs[os.path.join(self.project_path, path)] = info.split()[2]
+        return self._file_blobs
+
     def set_sha(self):
-        os.chdir(self.project_path)
+        if not self.checkout:
+            self.sha = subprocess.run(["git", "rev-parse", "--verify", f"{self.sha or 'HEAD'}^{{commit}}"],
+                                      cwd=self.project_path, capture_output=True, text=True,
+                                      check=True).stdout.strip()
+            return
         # check git status clean
-        result = subprocess.run(["git", "status", "--porcelain"], capture_output=True, text=True)
+        result = subprocess.run(["git", "status", "--porcelain"], cwd=self.project_path, capture_output=True,
+                                text=True)
         if result.stdout.strip():
             # directly clean
             self.restore_git_files()
             # raise RuntimeError(
             #     "Uncommitted changes detected. Please commit or stash your changes before switching commits.")
         if self.sha:
-            subprocess.run(["git", "checkout", self.sha], check=True)
-        else:
-            self.sha = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+            # a branch can only be checked out in one worktree, worktrees check out its commit instead
+            detach = ["--detach"] if self.project_path != self.index_root else []
+            subprocess.run(["git", "checkout", *detach, self.sha], cwd=self.project_path, check=True)
+        # snapshots are named by the full sha, whichever way the commit was given
+        self.sha = subprocess.run(["git", "rev-parse", "HEAD"], cwd=self.project_path, capture_output=True,
+                                  text=True).stdout.strip()
+
+    def resolve_commit(self, name):
+        # full sha of a commit name, None when the clone does not have it
+        result = subprocess.run(["git", "rev-parse", "--verify", "--quiet", f"{name}^{{commit}}"],
+                                cwd=self.project_path, capture_output=True, text=True)
+        return result.stdout.strip() if result.returncode == 0 else None
+
+    def index_file_name(self, file_name):
+        # name of a checked out file in the vector store
+        if self.project_path == self.index_root or not file_name.startswith(self.project_path):
+            return file_name
+        return self.index_root + file_name[len(self.project_path):]
+
+    def work_file_name(self, file_name):
+        # checked out file of a name in the vector store
+        if self.project_path == self.index_root or not file_name.startswith(self.index_root):
+            return file_name
+        return self.project_path + file_name[len(self.index_root):]
 
     def get_changed_filenames(self, commit1, commit2):
-        os.chdir(self.project_path)
-        result = subprocess.run(["git", "diff", commit1, commit2], check=True, capture_output=True,
-                                text=True, errors='ignore')
-        diff = result.stdout
-        lines = diff.splitlines()
+        # code files whose documents are removed and added to update a snapshot of commit1 to commit2, as paths
+        # under project_path. git compares the trees by blob hash and detects renames, no file content is diffed
+        key = (commit1, commit2)
+        if key in self._changed_files:
+            return self._changed_files[key]
+        result = subprocess.run(["git", "diff", "--name-status", "-M", "-z", "--no-ext-diff", commit1, commit2],
+                                cwd=self.project_path, check=True, capture_output=True, text=True)
+        fields = result.stdout.split('\0')
+        suffix = SUFFIX[self.language]
         old_files, new_files = set(), set()
-        for idx, line in enumerate(lines):
-            if line.startswith("diff --git"):
-                parts = line.split()  # Split the line and get the file path
-                if len(parts) >= 3:
-                    # remove "a/", "b/"
-                    old_file = os.path.join(self.project_path, parts[2][2:])
-                    new_file = os.path.join(self.project_path, parts[3][2:])
-                    info1, info2 = lines[idx+1], lines[idx+2]
-                    old_valid, new_valid = False, False
-                    if info1.startswith('deleted'):  # delete
-                        old_valid = True
-                    elif info1.startswith('new file'):  # add
-                        new_valid = True
-                    elif info1.startswith('index'):  # edit
-                        old_valid, new_valid = True, True
-                    elif info1.startswith('similarity'):
-                        if info2.startswith('rename'):
-                            old_valid, new_valid = True, True
-                        elif info2.startswith('copy'):
-                            new_valid = True
-                    elif info1.startswith('old mode'):  # mode change
-                        pass
-                    if old_valid and old_file.endswith(SUFFIX[self.language]):
-                        old_files.add(old_file)
-                    if new_valid and new_file.endswith(SUFFIX[self.language]):
-                        new_files.add(new_file)
-        return list(old_files), list(new_files)
+        idx = 0
+        while idx < len(fields) - 1:
+            status = fields[idx]
+            if status[0] in 'RC':
+                old_file, new_file = fields[idx + 1], fields[idx + 2]
+                idx += 3
+            else:
+                old_file = new_file = fields[idx + 1]
+                idx += 2
+            # a copy leaves its source unchanged, an addition has no old documents and a deletion no new ones
+            if status[0] not in 'AC' and old_file.endswith(suffix):
+                old_files.add(os.path.join(self.project_path, old_file))
+            if status[0] != 'D' and new_file.endswith(suffix):
+                new_files.add(os.path.join(self.project_path, new_file))
+        self._changed_files[key] = list(old_files), list(new_files)
+        return self._changed_files[key]
+
+    def nearest_indexed_sha(self, indexed):
+        # the commit among indexed (sha -> last use) whose snapshot needs the fewest changed files to update,
+        # the closest indexed ancestor competes with the most recently used snapshots of other branches
+        if not indexed:
+            return None
+        candidates = sorted((sha for sha in indexed if sha != self.sha), key=indexed.get,
+                            reverse=True)[:BASE_CANDIDATES]
+        result = subprocess.run(["git", "rev-list", f"--max-count={BASE_SEARCH_DEPTH}", self.sha],
+                                cwd=self.project_path, capture_output=True, text=True)
+        ancestor = next((sha for sha in result.stdout.split() if sha in indexed and sha != self.sha), None)
+        if ancestor and ancestor not in candidates:
+            candidates.insert(0, ancestor)
+        best, best_changes = None, None
+        for sha in candidates:
+            try:
+                old_files, new_files = self.get_changed_filenames(sha, self.sha)
+            except subprocess.CalledProcessError:
+                # snapshot of a commit this clone does not have
+                continue
+            changes = len(set(old_files) | set(new_files))
+            if best is None or changes < best_changes:
+                best, best_changes = sha, changes
+        if best:
+            print(f"Updating the snapshot of {best} with {best_changes} changed files.")
+        return best
 
     def list_files(self):
-        non_code_files = []
-        code_files = []
-
-        for root, dirs, files in os.walk(self.project_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                if file_path.endswith(SUFFIX[self.language]):
-                    code_files.append(file_path)
-                else:
-                    non_code_files.append(file_path)
-        return non_code_files, code_files
+        # relative paths of the tracked files and of the untracked files .gitignore does not exclude, read from
+        # the git index instead of walking .git, build output and dependency directories.
+        # without checkout, the files of the commit tree
+        command = ["git", "ls-files", "--cached", "--others", "--exclude-standard", "-z"] if self.checkout else \
+            ["git", "ls-tree", "-r", "-z", "--name-only", self.sha]
+        result = subprocess.run(command, cwd=self.project_path, capture_output=True, text=True, check=True)
+        return [path for path in result.stdout.split('\0') if path]
 
     def read_file(self, file_name):
+        if not self.checkout:
+            return decode_source(self.read_blob(file_name))
         with open(file_name, 'r', encoding='utf-8') as file:
             content = file.read()
         return content
@@ -142,6 +298,79 @@ class LLMCodeGenerator:
         else:
             return self.read_file(file_name)
 
+    def parse_files(self, file_names, parse_workers=PARSE_WORKERS):
+        # yield (file_name, snippets) in input order. snippets of blobs parsed before come from the snippet cache,
+        # the others are parsed by a process pool ahead of the consumer
+        code_parser = get_code_parser(self.language)
+        snippet_cache = SnippetCache(type(code_parser).__name__, PARSER_VERSION)
+        executor = None
+        max_pending = max(SQL_BATCH, parse_workers * PARSE_BATCH * 4)
+        # (file_name, cache key, cached snippets, (future, index) of a parsing task or None to parse here)
+        pending = deque()
+        new_snippets = []
+
+        def read_source(file_name):
+            return None if self.checkout else decode_source(self.read_blob(file_name))
+
+        def resolve(file_name, key, result):
+            if result is None:
+                snippets = code_parser.sort_code(file_name, read_source(file_name))
+            elif isinstance(result, tuple):
+                snippets = result[0].result()[result[1]]
+            else:
+                return file_name, result
+            # untracked files have no blob and are parsed every time
+            if key:
+                new_snippets.append((key, snippets))
+            return file_name, snippets
+
+        try:
+            for i in range(0, len(file_names), SQL_BATCH):
+                chunk = file_names[i:i + SQL_BATCH]
+                keys = {file_name: snippet_cache.key(self.file_blobs[file_name]) for file_name in chunk
+                        if file_name in self.file_blobs}
+                cached = snippet_cache.get_many(list(keys.values()))
+                misses = [file_name for file_name in chunk if keys.get(file_name) not in cached]
+                parsing = {}
+                if parse_workers > 1 and len(misses) > PARSE_BATCH:
+                    if executor is None:
+                        executor = ProcessPoolExecutor(parse_workers,
+                                                       mp_context=multiprocessing.get_context(PARSE_START_METHOD))
+                    for j in range(0, len(misses), PARSE_BATCH):
+                        batch = misses[j:j + PARSE_BATCH]
+                        contents = None if self.checkout else [read_source(file_name) for file_name in batch]
+                        future = executor.submit(parse_code_files, self.language, batch, contents)
+                        for idx, file_name in enumerate(batch):
+                            parsing[file_name] = (future, idx)
+                for file_name in chunk:
+                    key = keys.get(file_name)
+                    pending.append((file_name, key, cached[key] if key in cached else parsing.get(file_name)))
+                while len(pending) > max_pending:
+                    yield resolve(*pending.popleft())
+                    if len(new_snippets) >= SQL_BATCH:
+                        snippet_cache.put_many(new_snippets)
+                        new_snippets = []
+            while pending:
+                yield resolve(*pending.popleft())
+            snippet_cache.put_many(new_snippets)
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            print("Snippet cache:", snippet_cache.stats())
+            snippet_cache.close()
+
+    def content_key(self, file_name):
+        # files of the commit are identified by their blob, untracked files by their content
+        return self.file_blobs.get(file_name) or file_hash(file_name)
+
+    def group_duplicates(self, file_names):
+        # first file of each distinct content -> every file with that content
+        groups = self.indexing_policy.group_duplicates(file_names, self.content_key)
+        if len(groups) < len(file_names):
+            print(f"{len(file_names) - len(groups)} duplicate files share the snippets of "
+                  f"{sum(len(files) > 1 for files in groups.values())} others.")
+        return {files[0]: files for files in groups.values()}
+
     def write_code(self, output_project_path, code):
         with open(output_project_path, 'w', encoding='utf-8') as file:
             file.write(code)
@@ -221,73 +450,120 @@ class LLMCodeGenerator:
         response = self.llm.invoke(prompt_list, input_dict, None, False)
         self.user_instruction = f"<statement>{self.user_instruction}</statement>\n<guide>{response.content}</guide>"
         
-    def update_documents_to_vector_store(self, update_files, if_code=True):
-        for file_name in tqdm(update_files):
-            snippets = self.parse_file(file_name, if_code=if_code)
+    def update_documents_to_vector_store(self, update_files, if_code=True, parse_workers=PARSE_WORKERS):
+        from langchain_core.documents import Document
+
+        # identical files are parsed once and their snippets are added for every path
+        duplicates = self.group_duplicates(update_files)
+        file_snippets = self.parse_files(list(duplicates), parse_workers) if if_code else \
+            ((file_name, self.parse_file(file_name)) for file_name in duplicates)
+        for file_name, snippets in tqdm(file_snippets, total=len(duplicates)):
             # print(idx, file_name)
-            docs = []
-            for snippet in snippets:
-                class_name, content, position = snippet[0], snippet[1], snippet[2]
-                metadata = {'file_name': file_name,
-                            'if_code': if_code,
-                            'class_name': class_name, }
-                docs.append(Document(page_content=content, metadata=metadata))
-            if docs:
-                self.vector_store.add_documents(docs)
-
-    def update_summary_documents_to_vector_store(self, update_files, if_code=True):
-        # parse dart code and get summary from llm
-        for file_name in tqdm(update_files):
-            prompt_list = prompt_list_for_summarize_code(self.language, True)
-            snippets = self.parse_file(file_name, if_code=if_code)
-            # print(idx, file_name)
-            docs = []
-            for snippet in snippets:
-                class_name, content, position = snippet[0], snippet[1], snippet[2]
-                input_dict = {"file_name": file_name, "source_code": content}
-                try:
-                    response = self.llm.invoke(prompt_list=prompt_list, input_dict=input_dict, output_parser=None, record=False)
-                    summary = response.content
-                    metadata = {'file_name': file_name,
+            docs, lexical_texts = [], []
+            for linked_file in duplicates[file_name]:
+                for snippet in snippets:
+                    class_name, content, position = snippet[0], snippet[1], snippet[2]
+                    metadata = {'file_name': self.index_file_name(linked_file),
                                 'if_code': if_code,
-                                'class_name': class_name, }
-                    docs.append(Document(page_content=summary, metadata=metadata))
-                except Exception as e:
-                    print("Error occurred when creating code summary:", e)
-                    continue
+                                'class_name': class_name,
+                                'position': list(position), }
+                    docs.append(Document(page_content=content, metadata=metadata))
+                    lexical_texts.append(f"{os.path.basename(linked_file)} {class_name} {content}")
             if docs:
-                self.vector_store.add_documents(docs)
-
-    def set_vector_store(self, refresh=False, update_from_sha=None):
-        self.vector_store = VectorStore(self.embeddings_model, self.project_name, self.sha, update_from_sha)
-
-        # If local vector store data exists
+                self.vector_store.add_documents(docs, lexical_texts)
+
+    def update_summary_documents_to_vector_store(self, update_files, if_code=True, max_concurrency=MAX_CONCURRENCY,
+                                                 tokens_per_minute=None, parse_workers=PARSE_WORKERS):
+        from langchain_core.documents import Document
+
+        # parse dart code and get summary from llm, requests of different snippets run concurrently
+        # and unchanged snippets are served from the summary cache
+        summary_cache = SummaryCache(self.model_name, SUMMARIZE_PROMPT_VERSION, self.language)
+        summarizer = CodeSummarizer(lambda: self.llm, self.language, max_concurrency=max_concurrency,
+                                    tokens_per_minute=tokens_per_minute, cache=summary_cache)
+        # identical files are summarized once and their summaries are added for every path
+        duplicates = self.group_duplicates(update_files)
+        file_snippets = self.parse_files(list(duplicates), parse_workers) if if_code else \
+            ((file_name, self.parse_file(file_name)) for file_name in duplicates)
+        try:
+            for file_name, results in tqdm(summarizer.summarize(file_snippets), total=len(duplicates)):
+                docs, lexical_texts = [], []
+                for linked_file in duplicates[file_name]:
+                    for snippet, summary in results:
+                        class_name, content, position = snippet[0], snippet[1], snippet[2]
+                        metadata = {'file_name': self.index_file_name(linked_file),
+                                    'if_code': if_code,
+                                    'class_name': class_name,
+                                    'position': list(position), }
+                        # a snippet the api would not summarize is embedded by its code
+                        docs.append(Document(page_content=content if summary is None else summary,
+                                             metadata=metadata))
+                        # keyword search matches identifiers of the code itself, not only its summary
+                        lexical_texts.append(f"{os.path.basename(linked_file)} {class_name} {content}")
+                if docs:
+                    self.vector_store.add_documents(docs, lexical_texts)
+        finally:
+            print("Summary cache:", summary_cache.stats())
+            summary_cache.close()
+
+    def set_vector_store(self, refresh=False, update_from_sha=None, max_concurrency=MAX_CONCURRENCY,
+                         tokens_per_minute=None, index_type='auto', compression='none', content='summary',
+                         store_name=None, parse_workers=PARSE_WORKERS):
+        from model.vector_store import VectorStore, indexed_shas
+
+        # snippets are embedded by their llm summary or by their raw code, each in its own store
+        if store_name is None:
+            store_name = vector_store_name(self.project_name, content)
         if not refresh:
-            db_exists = self.vector_store.load_db()
-            if db_exists == 1:
-                return
-            elif db_exists == 2:
-                old_files, new_files = self.get_changed_filenames(update_from_sha, self.sha)
-                self.vector_store.remove_documents(old_files)
-                update_files = new_files
-            else:
-                update_files = self.code_files
-        else:
-            self.vector_store.load_refreshed_db()
-            update_files = self.code_files
+            # update the given snapshot or the one closest to this commit, unless the commit is indexed already
+            indexed = indexed_shas(store_name)
+            requested_sha = update_from_sha
+            if update_from_sha is not None:
+                # snapshots are named by the full sha, a short sha, tag or branch is resolved first
+                update_from_sha = self.resolve_commit(update_from_sha)
+            if self.sha not in indexed and update_from_sha not in indexed:
+                if requested_sha is not None:
+                    print(f"No snapshot of {requested_sha} found, updating the nearest indexed one instead.")
+                update_from_sha = self.nearest_indexed_sha(indexed)
+        self.vector_store = VectorStore(self.embeddings_model, store_name, self.sha, update_from_sha,
+                                        index_type=index_type, compression=compression)
 
-        # embedding with original code
-        # self.update_documents_to_vector_store(update_files)
-
-        # embedding with summarized code
-        self.update_summary_documents_to_vector_store(update_files)
+        try:
+            # If local vector store data exists
+            if not refresh:
+                db_exists = self.vector_store.load_db()
+                if db_exists == 1:
+                    return
+                elif db_exists == 2:
+                    old_files, new_files = self.get_changed_filenames(update_from_sha, self.sha)
+                    self.vector_store.remove_documents([self.index_file_name(file_name) for file_name in old_files])
+                    update_files = self.indexing_policy.select(new_files)
+                else:
+                    update_files = self.indexed_files
+            else:
+                self.vector_store.load_refreshed_db()
+                update_files = self.indexed_files
 
-        # save db
-        self.vector_store.save_db()
+            if content == 'code':
+                # embedding with original code
+                self.update_documents_to_vector_store(update_files, parse_workers=parse_workers)
+            else:
+                # embedding with summarized code
+                self.update_summary_documents_to_vector_store(update_files, max_concurrency=max_concurrency,
+                                                              tokens_per_minute=tokens_per_minute,
+                                                              parse_workers=parse_workers)
+
+            # save db
+            self.vector_store.save_db()
+        finally:
+            # the git reader is closed when the build fails as well
+            if self._git_objects is not None:
+                self._git_objects.close()
 
     def create_git_diff(self):
         result = subprocess.run(
             ["git", "diff", "--ignore-space-change"],
+            cwd=self.project_path,
             check=True,
             capture_output=True,
             text=True
@@ -307,8 +583,9 @@ class LLMCodeGenerator:
                 if self.language == 'flutter':
                     try:
                         input_data = "y\ny\ny\ny\n"
-                        process = subprocess.Popen("fvm dart analyze", shell=True, stdin=subprocess.PIPE,
-                                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                        process = subprocess.Popen("fvm dart analyze", shell=True, cwd=self.project_path,
+                                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                                   stderr=subprocess.PIPE, text=True)
                         stdout, stderr = process.communicate(input=input_data, timeout=120)
                         message += f"Syntax check passed for {file_path}."
                     except subprocess.CalledProcessError as e:
@@ -329,17 +606,22 @@ class LLMCodeGenerator:
             print("Patch validation failed. Error message:", all_message)
         return all_success, all_message
 
-    def generate_patch(self):
+    def generate_patch(self, token_budget=CONTEXT_TOKEN_BUDGET, context_candidates=CONTEXT_CANDIDATES):
+        from langchain_core.documents import Document
+        from model.output_parser import FileOutputParser
+
         log_message = ''
-        matched_docs = self.vector_store.match_documents(self.user_instruction)
-        matched_files = list(set([doc.metadata['file_name'] for doc in matched_docs]))
+        matched_docs = self.vector_store.match_documents(self.user_instruction, k=context_candidates)
+        # the context shows, and the model patches, the files of this checkout
+        matched_docs = [Document(page_content=doc.page_content,
+                                 metadata={**doc.metadata, 'file_name': self.work_file_name(doc.metadata['file_name'])})
+                        for doc in matched_docs]
+        matched_files = list(dict.fromkeys(doc.metadata['file_name'] for doc in matched_docs))
         print("matched_files:\n", ', '.join(matched_files))
-        code_with_location = ''
-        for index, matched_file in enumerate(matched_files):
-            prefix = f'[start of {matched_file}]'
-            postfix = f'[end of {matched_file}]\n'
-            code = self.read_file(matched_file)
-            code_with_location += prefix + code + postfix
+        # retrieved snippets with their surrounding lines are packed up to the token budget instead of whole files
+        context_builder = ContextBuilder(self.language, self.model_name, token_budget=token_budget)
+        code_with_location, self.context_tokens = context_builder.build(matched_docs)
+        print(f"Context of {self.context_tokens} tokens built from {len(matched_docs)} snippets.")
         input_dict = {"code_with_location": code_with_location, "user_instruction": self.user_instruction}
         prompt_list = prompt_list_for_position_and_patch(language=self.language)
         modifications = self.llm.invoke(prompt_list=prompt_list, input_dict=input_dict, output_parser=FileOutputParser())
@@ -364,28 +646,151 @@ class LLMCodeGenerator:
         return matched_docs, all_success, log_message
 
     def restore_git_files(self):
-        os.chdir(self.project_path)
-        subprocess.run(["git", "restore", "--staged", "."], check=True)
-        subprocess.run(["git", "restore", "."], check=True)
-        subprocess.run(["git", "clean", "-fd"], check=True)
+        subprocess.run(["git", "restore", "--staged", "."], cwd=self.project_path, check=True)
+        subprocess.run(["git", "restore", "."], cwd=self.project_path, check=True)
+        subprocess.run(["git", "clean", "-fd"], cwd=self.project_path, check=True)
+
+
+# (store name, full sha) -> lock held while the snapshot is built
+index_locks = {}
+index_locks_guard = threading.Lock()
+
+
+@contextmanager
+def index_lock(store_name, sha):
+    # threads of this process wait on a threading lock, other processes on a file lock next to the manifests
+    from model.vector_store import project_dir
+
+    with index_locks_guard:
+        lock = index_locks.setdefault((store_name, sha), threading.Lock())
+    with lock:
+        if fcntl is None:
+            yield
+            return
+        lock_dir = os.path.join(project_dir(store_name), 'locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(os.path.join(lock_dir, f'{sha}.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def index_commit(language, project_name, project_path, sha, model_name="gpt-4o-mini", include_globs=None,
+                 exclude_globs=None, skip_generated=True, **kwargs):
+    # build the vector store of a commit from the git object database without checking it out.
+    # kwargs are passed to set_vector_store. returns the full sha
+    generator = LLMCodeGenerator(language=language, project_name=project_name, project_path=project_path,
+                                 user_instruction='', sha=sha, model_name=model_name, include_globs=include_globs,
+                                 exclude_globs=exclude_globs, skip_generated=skip_generated, checkout=False)
+    store_name = kwargs.get('store_name') or vector_store_name(project_name, kwargs.get('content', 'summary'))
+    # overlapping runs and indexers, also of other processes, index the same commit once, the later ones load
+    # the saved snapshot
+    with index_lock(store_name, generator.sha):
+        generator.set_vector_store(**kwargs)
+    return generator.sha
+
+
+def index_commits(language, project_name, project_path, shas, workers=1, model_name="gpt-4o-mini", **kwargs):
+    # build the vector stores of several commits in parallel, returns the full shas in input order
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(lambda sha: index_commit(language, project_name, project_path, sha, model_name,
+                                                          **kwargs), shas))
+
+
+class CommitIndexer:
+    # indexes the commits of a run in background threads while the caller works on earlier ones.
+    # at most `ahead` commits beyond the one waited for are submitted, one worker indexes them in order so
+    # each commit updates the snapshot of the one before
+    def __init__(self, language, project_name, project_path, shas, workers=1, ahead=INDEX_AHEAD,
+                 model_name="gpt-4o-mini", **kwargs):
+        self.language = language
+        self.project_name = project_name
+        self.project_path = project_path
+        self.model_name = model_name
+        self.kwargs = kwargs
+        self.shas = list(dict.fromkeys(shas))
+        self.positions = {sha: idx for idx, sha in enumerate(self.shas)}
+        self.ahead = ahead
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.futures = {}
+        # worker threads of the batch runner call wait concurrently
+        self.lock = threading.Lock()
+        self.submit_until(0)
+
+    def submit_until(self, position):
+        with self.lock:
+            self._submit_until(position)
+
+    def _submit_until(self, position):
+        while len(self.futures) < len(self.shas) and len(self.futures) <= position + self.ahead:
+            sha = self.shas[len(self.futures)]
+            self.futures[sha] = self.executor.submit(index_commit, self.language, self.project_name,
+                                                     self.project_path, sha, self.model_name, **self.kwargs)
+
+    def wait(self, sha):
+        # block until the vector store of sha is built. False when indexing failed or sha is not part of the run,
+        # set_vector_store of the caller then builds it
+        if sha not in self.positions:
+            return False
+        self.submit_until(self.positions[sha])
+        with self.lock:
+            future = self.futures[sha]
+        try:
+            future.result()
+            return True
+        except Exception as e:
+            print(f"Error occurred when indexing {sha}:", e)
+            return False
+
+    def close(self):
+        self.executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
-def main(home_path, repo, repo_type, language, commit_sha, last_commit_sha, model_name, user_instruction, log_dir):
+def main(home_path, repo, repo_type, language, commit_sha, last_commit_sha, model_name, user_instruction, log_dir,
+         max_concurrency=MAX_CONCURRENCY, tokens_per_minute=None, index_type='auto', compression='none',
+         token_budget=CONTEXT_TOKEN_BUDGET, content='summary', parse_workers=PARSE_WORKERS, include_globs=None,
+         exclude_globs=None, keep_generated=False):
     start_time = datetime.datetime.now()
     if repo_type == "github":
-        git_clone_repo(repo, False)
+        git_clone_repo(repo, False, home_path)
         project_name = repo.split('/')[1]
     else:
         project_name = repo
     generator = LLMCodeGenerator(language=language, project_name=project_name,
                                                  project_path=home_path,
                                                  user_instruction=user_instruction, sha=commit_sha,
-                                             model_name=model_name)
+                                             model_name=model_name, include_globs=include_globs,
+                                             exclude_globs=exclude_globs, skip_generated=not keep_generated)
 
-    generator.set_vector_store(refresh=False, update_from_sha=last_commit_sha)
+    generator.set_vector_store(refresh=False, update_from_sha=last_commit_sha, max_concurrency=max_concurrency,
+                               tokens_per_minute=tokens_per_minute, index_type=index_type, compression=compression,
+                               content=content, parse_workers=parse_workers)
+    log_info = patch_instruction(generator, repo, repo_type, language, commit_sha, model_name, token_budget,
+                                 start_time)
+
+    #save log
+    if not os.path.exists(log_dir):
+        os.mkdir(log_dir)
+    with open(os.path.join(log_dir, f'{project_name}_{commit_sha}_log.json'), 'a', encoding='utf-8') as f:
+        json.dump(log_info, f)
+    print('Log saved to',os.path.join(log_dir, f'{project_name}_{commit_sha}_log.json'), datetime.datetime.now())
+
+
+def patch_instruction(generator, repo, repo_type, language, commit_sha, model_name,
+                      token_budget=CONTEXT_TOKEN_BUDGET, start_time=None):
+    # generate and validate the patch of the instruction of a generator whose vector store is set,
+    # returns the log of the run
+    start_time = start_time or datetime.datetime.now()
     log_info = dict()
-    matched_docs, all_success, all_message = generator.generate_patch()
+    matched_docs, all_success, all_message = generator.generate_patch(token_budget=token_budget)
     print('Log message:\n', all_message)
     model_patch = generator.create_git_diff()
     print('Update patch applied:\n', model_patch)
@@ -396,21 +801,19 @@ def main(home_path, repo, repo_type, language, commit_sha, last_commit_sha, mode
     log_info["language"] = language
     log_info["commit_sha"] = commit_sha
     log_info["token_usage"] = token_usage
+    log_info["context_tokens"] = generator.context_tokens
     log_info["model_patch"] = model_patch
     log_info["model_name"] = model_name
     log_info["run_time"] = (end_time - start_time).total_seconds()
     log_info["matched_docs"] = str(matched_docs)
     log_info["log_message"] = all_message
     log_info["success"] = all_success
+    return log_info
 
-    #save log
-    if not os.path.exists(log_dir):
-        os.mkdir(log_dir)
-    with open(os.path.join(log_dir, f'{project_name}_{commit_sha}_log.json'), 'a', encoding='utf-8') as f:
-        json.dump(log_info, f)
-    print('Log saved to',os.path.join(log_dir, f'{project_name}_{commit_sha}_log.json'), datetime.datetime.now())
 
 if __name__ == "__main__":
+    from model.index_factory import INDEX_TYPES, COMPRESSIONS
+
     parser = ArgumentParser()
     parser.add_argument("--repo", type=str, help="Full name of the repository")
     parser.add_argument("--repo_type", type=str, choices=["local", "github"],
@@ -421,10 +824,34 @@ if __name__ == "__main__":
     parser.add_argument("--commit_sha", type=str, default=None,
                         help="The sha of the commit to modify. Use lastest commit as default")
     parser.add_argument("--last_commit_sha", type=str, default=None,
-                        help="The sha of last commit. Use the second lastest commit as default")
+                        help="The sha of an indexed commit to update the vector store from. Use the indexed "
+                             "commit with the fewest changed files as default")
     parser.add_argument("--model_name", type=str, default="gpt-4o", help="Model name of Openai LLM API.")
     parser.add_argument("--home_path", type=str, default=HOME, help="Path to the repo. Use home directory as default.")
     parser.add_argument("--log_dir", type=str, default=os.path.join(root,'log'), help="Full path to the log dir.")
+    parser.add_argument("--max_concurrency", type=int, default=MAX_CONCURRENCY,
+                        help="Maximum number of code summary requests in flight when building the vector store.")
+    parser.add_argument("--tokens_per_minute", type=int, default=None,
+                        help="Token per minute budget of code summary requests. 150000 as default when requests "
+                             "run concurrently, 0 disables the limit.")
+    parser.add_argument("--index_type", type=str, default='auto', choices=list(INDEX_TYPES),
+                        help="Vector index type. 'auto' selects flat, hnsw or ivf by corpus size.")
+    parser.add_argument("--compression", type=str, default='none', choices=list(COMPRESSIONS),
+                        help="Encoding of stored vectors: full precision, float16, int8 scalar or product "
+                             "quantization.")
+    parser.add_argument("--token_budget", type=int, default=CONTEXT_TOKEN_BUDGET,
+                        help="Prompt tokens of retrieved code context packed from the matched snippets.")
+    parser.add_argument("--content", type=str, default='summary', choices=['summary', 'code'],
+                        help="Embed llm summaries of the code snippets or the raw snippets.")
+    parser.add_argument("--parse_workers", type=int, default=PARSE_WORKERS,
+                        help="Processes parsing code files while indexing. Use the number of cores as default.")
+    parser.add_argument("--include_globs", type=str, nargs='*', default=None,
+                        help="Only index code files whose path relative to the repo matches one of these globs.")
+    parser.add_argument("--exclude_globs", type=str, nargs='*', default=None,
+                        help="Skip code files matching these globs, in addition to build output and vendored "
+                             "packages.")
+    parser.add_argument("--keep_generated", action='store_true',
+                        help="Also index generated code files like *.g.dart and files with a generated header.")
     args = parser.parse_args()
     main(**vars(args))
 
@@ -0,0 +1,18 @@
+import os
+import sys
+from argparse import ArgumentParser
+current_path = os.path.abspath(__file__)
+root = os.path.dirname(os.path.dirname(current_path))
+sys.path.append(root)
+
+from model.vector_store import collect_garbage
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("--max_gb", type=float, required=True,
+                        help="Disk space the vector store snapshots may use in total.")
+    parser.add_argument("--project_name", type=str, default=None,
+                        help="Only collect snapshots of this project. Use all projects as default.")
+    args = parser.parse_args()
+    collect_garbage(int(args.max_gb * 1024 ** 3), args.project_name)
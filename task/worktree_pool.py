@@ -0,0 +1,70 @@
+import os
+import queue
+import subprocess
+import threading
+from contextlib import contextmanager
+
+# checkouts of one repository kept for concurrent tasks
+WORKTREE_POOL_SIZE = 8
+
+
+def worktree_root(repo_path):
+    # next to the clone, so the worktrees never show up as untracked files of the clone
+    return os.path.join(os.path.dirname(repo_path), '.worktrees', os.path.basename(repo_path))
+
+
+class WorktreePool:
+    # isolated `git worktree` checkouts of a clone leased to one task at a time. a returned worktree is reset to
+    # its commit and cleaned, it is reused by the next lease instead of being created again
+    def __init__(self, repo_path, size=WORKTREE_POOL_SIZE, root=None):
+        self.repo_path = repo_path
+        self.size = max(1, size)
+        self.root = root or worktree_root(repo_path)
+        # worktree bookkeeping in the clone is serialized, checkouts inside the worktrees run in parallel
+        self.admin_lock = threading.Lock()
+        self.free = queue.Queue()
+        for idx in range(self.size):
+            self.free.put(os.path.join(self.root, str(idx)))
+
+    def git(self, *args, cwd=None):
+        return subprocess.run(["git", *args], cwd=cwd or self.repo_path, check=True, capture_output=True,
+                              text=True)
+
+    def prepare(self, path, sha):
+        if os.path.isfile(os.path.join(path, '.git')):
+            # left by an earlier run or lease
+            self.git("checkout", "--detach", "--force", sha, cwd=path)
+        else:
+            with self.admin_lock:
+                # drop the registration of a worktree whose directory was deleted
+                self.git("worktree", "prune")
+                os.makedirs(self.root, exist_ok=True)
+                self.git("worktree", "add", "--detach", "--force", path, sha)
+        return path
+
+    def reset(self, path):
+        # undo the patch of the task, ignored build output like .dart_tool is kept for the next lease
+        self.git("reset", "--hard", "--quiet", cwd=path)
+        self.git("clean", "-fd", "--quiet", cwd=path)
+
+    @contextmanager
+    def lease(self, sha):
+        # absolute path of a worktree checked out at sha, blocks while every worktree is leased
+        path = self.free.get()
+        try:
+            yield self.prepare(path, sha)
+        finally:
+            try:
+                if os.path.isdir(path):
+                    self.reset(path)
+            finally:
+                self.free.put(path)
+
+    def remove(self):
+        # delete every worktree of the pool, none may be leased
+        with self.admin_lock:
+            for idx in range(self.size):
+                path = os.path.join(self.root, str(idx))
+                if os.path.isdir(path):
+                    self.git("worktree", "remove", "--force", path)
+            self.git("worktree", "prune")
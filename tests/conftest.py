@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def git(path, *args):
+    return subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args], cwd=path,
+                          check=True, capture_output=True, text=True).stdout.strip()
+
+
+def write_files(path, files):
+    for name, content in files.items():
+        file_name = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, 'w') as file:
+            file.write(content)
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    # caches and vector stores of the test, never the ones of the checkout
+    from model import cache, vector_store
+
+    monkeypatch.setattr(cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(vector_store, 'VECTORSTORE', str(tmp_path / 'vectorstore'))
+    return tmp_path
+
+
+@pytest.fixture
+def python_repo(tmp_path):
+    # clone 'proj' under tmp_path/projects with one commit of python files, returns the directory of the clone
+    path = tmp_path / 'projects' / 'proj'
+    path.mkdir(parents=True)
+    git(path, 'init', '-q', '-b', 'master')
+    write_files(path, {f'pkg/module_{idx}.py': f'def function_{idx}(value):\n    return value + {idx}\n'
+                       for idx in range(40)})
+    git(path, 'add', '.')
+    git(path, 'commit', '-q', '-m', 'first')
+    return str(path)
@@ -0,0 +1,52 @@
+import json
+import os
+
+from task import run_command
+from task.batch_run import BatchRunner, read_checkpoint
+from test_run_task import fake_embeddings
+
+
+def request(request_id, repo, commit_sha):
+    return {"request_id": request_id, "repo": repo, "repo_type": "local", "language": "python",
+            "commit_sha": commit_sha, "user_instruction": "instruction"}
+
+
+def test_deterministic_failures_are_checkpointed(storage, python_repo):
+    checkpoint = str(storage / 'log' / 'checkpoint.jsonl')
+    runner = BatchRunner(os.path.dirname(python_repo), 'model', str(storage / 'log'), checkpoint)
+    results = runner.run([request('missing_commit', 'proj', 'no-such-commit'),
+                          request('missing_repo', 'other', None),
+                          {**request('no_language', 'proj', None), "language": None}])
+    assert {request_id: log_info["success"] for request_id, log_info in results.items()} == \
+        {'missing_commit': False, 'missing_repo': False, 'no_language': False}
+    assert set(read_checkpoint(checkpoint)) == {'missing_commit', 'missing_repo', 'no_language'}
+    with open(checkpoint, 'r', encoding='utf-8') as file:
+        assert all(json.loads(line)["log_message"] for line in file)
+
+
+def test_transient_failures_are_retried_on_resume(storage, python_repo, monkeypatch):
+    fake_embeddings(monkeypatch)
+    checkpoint = str(storage / 'log' / 'checkpoint.jsonl')
+    runner = BatchRunner(os.path.dirname(python_repo), 'model', str(storage / 'log'), checkpoint, content='code',
+                         parse_workers=1)
+
+    def unavailable(*args):
+        raise RuntimeError('Code summary failed, the vector store is not saved.') from ConnectionError('reset')
+
+    monkeypatch.setattr(runner, 'run_request', unavailable)
+    assert runner.run([request('offline', 'proj', None)]) == {}
+    assert read_checkpoint(checkpoint) == {}
+
+    def rejected(*args):
+        raise KeyError('language')
+
+    monkeypatch.setattr(runner, 'run_request', rejected)
+    assert runner.run([request('broken', 'proj', None)])['broken']['success'] is False
+    assert set(read_checkpoint(checkpoint)) == {'broken'}
+
+
+def test_github_repos_are_cloned_into_home_path(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(run_command.subprocess, 'run', lambda args, cwd, check: calls.append((args, cwd)))
+    run_command.git_clone_repo('owner/proj', home_path=str(tmp_path))
+    assert calls == [(["git", "clone", "https://github.com/owner/proj.git", "proj"], str(tmp_path))]
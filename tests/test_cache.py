@@ -0,0 +1,29 @@
+from model.cache import SummaryCache, EmbeddingCache, SnippetCache
+
+
+def test_caches_round_trip(tmp_path):
+    summaries = SummaryCache('model', 1, 'python', path=str(tmp_path / 'summary.sqlite'))
+    summaries.put_many([(summaries.key('code'), 'summary')])
+    assert summaries.get_many([summaries.key('code'), summaries.key('other')]) == {summaries.key('code'): 'summary'}
+    assert summaries.stats()['hits'] == 1 and summaries.stats()['misses'] == 1
+    summaries.close()
+
+    embeddings = EmbeddingCache('model', path=str(tmp_path / 'embedding.sqlite'))
+    embeddings.put_many([('key', [0.5, 1.0])])
+    assert embeddings.get_many(['key']) == {'key': [0.5, 1.0]}
+    embeddings.close()
+
+    snippets = SnippetCache('PythonParser', 3, path=str(tmp_path / 'snippet.sqlite'))
+    snippets.put_many([('key', [('Name', 'class Name: pass', (1, 1))])])
+    assert snippets.get_many(['key']) == {'key': [('Name', 'class Name: pass', (1, 1))]}
+    snippets.close()
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = SummaryCache('model', 1, 'python', path=str(tmp_path / 'summary.sqlite'), max_entries=2)
+    for key in ('a', 'b', 'c'):
+        cache.put_many([(key, key)])
+    cache.get_many(['a'])
+    assert cache.evict() == 1
+    assert set(cache.get_many(['a', 'b', 'c'])) == {'a', 'c'}
+    cache.close()
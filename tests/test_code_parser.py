@@ -0,0 +1,73 @@
+from utils.code_parser import dart_declarations, PythonParser, DartParser, MAX_SNIPPET_TOKENS, \
+    CHARS_PER_TOKEN
+
+
+def declarations(content):
+    return [(kind, name) for kind, name, _, _, _ in dart_declarations(content)]
+
+
+def test_dart_declarations():
+    content = """
+import 'package:flutter/material.dart';
+
+/// A widget.
+@immutable
+class Counter<T extends num> extends StatelessWidget {
+  final String label = '}';
+}
+
+mixin Logging on Object {}
+extension StringCase on String {}
+extension type UserId(int id) {}
+enum Color { red, green }
+typedef Callback = void Function(int);
+final Map<String, int> counts = {};
+int twice(int x) => x * 2;
+void main() {}
+"""
+    assert declarations(content) == [('class', 'Counter'), ('mixin', 'Logging'), ('extension', 'StringCase'),
+                                     ('extension', 'UserId'), ('enum', 'Color'), ('function', 'twice'),
+                                     ('function', 'main')]
+
+
+def test_dart_generic_function_names():
+    content = """
+T first<T>(List<T> items) => items[0];
+Map<String, List<int>> group<K, V extends Comparable<V>>(Iterable<V> values) {
+  return {};
+}
+@Annotation<int>()
+Future<void> load() async {}
+"""
+    assert declarations(content) == [('function', 'first'), ('function', 'group'), ('function', 'load')]
+
+
+def assert_bounded(code):
+    assert code
+    for _, snippet, _ in code:
+        assert len(snippet) // CHARS_PER_TOKEN + 1 <= MAX_SNIPPET_TOKENS
+
+
+def test_long_python_module_code_is_bounded(tmp_path):
+    body = ''.join(f'    value_{idx} = compute({idx}, "{"x" * 40}")\n' for idx in range(2000))
+    content = f'def main():\n{body}\n\nif __name__ == "__main__":\n{body}\nTABLE = ["{"y" * 50000}"]\n'
+    code = PythonParser().sort_code(str(tmp_path / 'main.py'), content)
+    assert_bounded(code)
+    assert ''.join(snippet for _, snippet, _ in code) == content
+
+
+def test_unparseable_python_file_is_bounded(tmp_path):
+    content = 'def broken(:\n' + ''.join(f'    line_{idx} = {idx}\n' for idx in range(5000))
+    code = PythonParser().sort_code(str(tmp_path / 'broken.py'), content)
+    assert len(code) > 1
+    assert_bounded(code)
+    assert ''.join(snippet for _, snippet, _ in code) == content
+
+
+def test_long_dart_top_level_code_is_bounded(tmp_path):
+    entries = ''.join(f"  'route_{idx}': (context) => const Page{idx}(),\n" for idx in range(2000))
+    statements = ''.join(f'  print({idx});\n' for idx in range(5000))
+    content = f'final routes = {{\n{entries}}};\n\nvoid main() {{\n{statements}}}\n'
+    code = DartParser().sort_code(str(tmp_path / 'main.dart'), content)
+    assert_bounded(code)
+    assert {name for name, _, _ in code} == {'', 'main'}
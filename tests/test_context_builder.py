@@ -0,0 +1,56 @@
+import pytest
+from langchain_core.documents import Document
+
+from conftest import write_files
+from model import context_builder
+from model.context_builder import ContextBuilder
+
+
+def count_words(text):
+    return len(text.split())
+
+
+@pytest.fixture
+def files(tmp_path, monkeypatch):
+    monkeypatch.setattr(context_builder, 'MIN_PARTIAL_TOKENS', 1)
+    write_files(tmp_path, {
+        'a.py': 'a = 1\nb = 2\n',
+        'b.py': 'long = ' + ' + '.join(['1'] * 20) + '\nc = 3\nd = 4\n',
+        'c.py': ''.join(f'v{idx} = {idx}\n' for idx in range(10)),
+    })
+    return lambda name: str(tmp_path / name)
+
+
+def doc(file_name, position=None):
+    metadata = {'file_name': file_name}
+    if position is not None:
+        metadata['position'] = position
+    return Document(page_content='', metadata=metadata)
+
+
+def test_snippets_are_numbered_by_file_line_and_share_lines(files):
+    builder = ContextBuilder('python', token_budget=None, context_lines=0, count_tokens=count_words)
+    text, used = builder.build([doc(files('c.py'), (2, 3)), doc(files('c.py'), (6, 6)), doc(files('c.py'), (3, 4))])
+    assert text == (f'[start of {files("c.py")}]\n[1]v1 = 1\n[2]v2 = 2\n[3]v3 = 3\n[...]\n[5]v5 = 5\n'
+                    f'[end of {files("c.py")}]\n')
+    assert builder.selected == {files('c.py'): {1, 2, 3, 5}}
+    assert used == count_words(text) - 1
+
+
+def test_budget_cutoff_keeps_the_head_of_the_last_snippet(files):
+    # a.py costs 6 for its header and 3 per line, the head of c.py gets the remaining 4 lines
+    builder = ContextBuilder('python', token_budget=12 + 6 + 12, context_lines=0, count_tokens=count_words)
+    text, used = builder.build([doc(files('a.py')), doc(files('c.py')), doc(files('a.py'))])
+    assert used == 30
+    assert builder.selected == {files('a.py'): {0, 1}, files('c.py'): {0, 1, 2, 3}}
+    assert text.endswith(f'[start of {files("c.py")}]\n[0]v0 = 0\n[1]v1 = 1\n[2]v2 = 2\n[3]v3 = 3\n'
+                         f'[end of {files("c.py")}]\n')
+
+
+def test_file_whose_first_line_does_not_fit_is_skipped(files):
+    # the first line of b.py alone exceeds the remainder, its header is not charged so c.py still fits
+    builder = ContextBuilder('python', token_budget=12 + 6 + 5, context_lines=0, count_tokens=count_words)
+    text, used = builder.build([doc(files('a.py')), doc(files('b.py')), doc(files('c.py'), (1, 1))])
+    assert files('b.py') not in text
+    assert builder.selected == {files('a.py'): {0, 1}, files('c.py'): {0}}
+    assert used == 12 + 9
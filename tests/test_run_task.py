@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+from conftest import git, write_files
+from task import run_task
+from task.run_task import LLMCodeGenerator, PARSE_BATCH
+
+
+def test_parse_files_in_worker_processes(storage, python_repo):
+    generator = LLMCodeGenerator('python', 'proj', os.path.dirname(python_repo), 'instruction', checkout=False)
+    file_names = sorted(generator.code_files)
+    assert len(file_names) > PARSE_BATCH
+    parsed = dict(generator.parse_files(file_names, parse_workers=2))
+    assert list(parsed) == file_names
+    name, code, position = parsed[os.path.join(python_repo, 'pkg', 'module_7.py')][0]
+    assert (name, position) == ('function_7', (1, 2))
+    assert 'return value + 7' in code
+
+
+def fake_embeddings(monkeypatch):
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+
+    monkeypatch.setattr(run_task, 'create_embeddings_model', lambda: DeterministicFakeEmbedding(size=16))
+
+
+def test_overlapping_commits_are_indexed_once(storage, python_repo, monkeypatch):
+    fake_embeddings(monkeypatch)
+    builds = []
+    update = LLMCodeGenerator.update_documents_to_vector_store
+
+    def counted_update(self, *args, **kwargs):
+        builds.append(self.sha)
+        return update(self, *args, **kwargs)
+
+    monkeypatch.setattr(LLMCodeGenerator, 'update_documents_to_vector_store', counted_update)
+    shas = run_task.index_commits('python', 'proj', os.path.dirname(python_repo), ['master', 'HEAD', 'master'],
+                                  workers=3, content='code', parse_workers=1)
+    assert len(set(shas)) == 1
+    assert builds == shas[:1]
+
+
+@pytest.mark.skipif(run_task.fcntl is None, reason='file locks need fcntl')
+def test_index_lock_is_held_across_processes(storage):
+    from model.vector_store import project_dir
+
+    with run_task.index_lock('proj_code', 'a' * 40):
+        # flock conflicts between open files, so a second open stands in for another process
+        with open(os.path.join(project_dir('proj_code'), 'locks', 'a' * 40 + '.lock'), 'w') as lock_file:
+            with pytest.raises(BlockingIOError):
+                run_task.fcntl.flock(lock_file, run_task.fcntl.LOCK_EX | run_task.fcntl.LOCK_NB)
+    with open(os.path.join(project_dir('proj_code'), 'locks', 'a' * 40 + '.lock'), 'w') as lock_file:
+        run_task.fcntl.flock(lock_file, run_task.fcntl.LOCK_EX | run_task.fcntl.LOCK_NB)
+
+
+def test_failed_build_closes_the_summary_cache_and_git_reader(storage, python_repo, monkeypatch):
+    fake_embeddings(monkeypatch)
+    closed = []
+
+    class ClosedSummaryCache(run_task.SummaryCache):
+        def close(self):
+            closed.append(self)
+            super().close()
+
+    class UnavailableLlm:
+        def invoke(self, *args, **kwargs):
+            raise ConnectionError('connection reset')
+
+    monkeypatch.setattr(run_task, 'SummaryCache', ClosedSummaryCache)
+    generator = LLMCodeGenerator('python', 'proj', os.path.dirname(python_repo), 'instruction', checkout=False)
+    generator._llm = UnavailableLlm()
+    with pytest.raises(RuntimeError):
+        generator.set_vector_store(max_concurrency=2, parse_workers=1)
+    assert len(closed) == 1
+    assert generator.git_objects.process is None
+
+
+def test_update_from_a_short_sha_tag_or_missing_commit(storage, python_repo, monkeypatch):
+    fake_embeddings(monkeypatch)
+    project_path = os.path.dirname(python_repo)
+    first = git(python_repo, 'rev-parse', 'HEAD')
+    git(python_repo, 'tag', 'v1')
+    write_files(python_repo, {'pkg/module_1.py': 'def changed(value):\n    return value * 2\n'})
+    git(python_repo, 'commit', '-q', '-am', 'second')
+    updates = []
+    update = LLMCodeGenerator.update_documents_to_vector_store
+
+    def counted_update(self, update_files, *args, **kwargs):
+        updates.append(sorted(os.path.basename(file_name) for file_name in update_files))
+        return update(self, update_files, *args, **kwargs)
+
+    monkeypatch.setattr(LLMCodeGenerator, 'update_documents_to_vector_store', counted_update)
+    for idx, name in enumerate((first[:7], 'v1', 'no-such-commit')):
+        run_task.index_commit('python', 'proj', project_path, first, content='code', store_name=f'proj-{idx}',
+                              parse_workers=1)
+        generator = LLMCodeGenerator('python', 'proj', project_path, 'instruction', checkout=False)
+        generator.set_vector_store(update_from_sha=name, content='code', store_name=f'proj-{idx}',
+                                   parse_workers=1)
+        # only the changed file is indexed, a missing commit falls back to the nearest snapshot
+        assert updates[-1] == ['module_1.py']
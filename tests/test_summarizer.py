@@ -0,0 +1,37 @@
+import pytest
+
+from model.summarizer import CodeSummarizer
+
+
+class Response:
+    def __init__(self, content):
+        self.content = content
+        self.response_metadata = {}
+
+
+class FakeLlm:
+    # None for rejected snippets like Openai.invoke, raises for unavailable ones
+    def invoke(self, prompt_list, input_dict, output_parser, record, raise_account_errors):
+        if 'rejected' in input_dict['source_code']:
+            return None
+        if 'unavailable' in input_dict['source_code']:
+            raise ConnectionError('connection reset')
+        return Response(f"summary of {input_dict['source_code']}")
+
+
+def file_snippets(*contents):
+    return [(f'file_{idx}.py', [('', content, (1, 1))]) for idx, content in enumerate(contents)]
+
+
+def test_rejected_snippets_have_no_summary():
+    summarizer = CodeSummarizer(FakeLlm(), 'python', max_concurrency=2)
+    results = dict(summarizer.summarize(file_snippets('a', 'rejected', 'b')))
+    assert [summary for _, summary in results['file_1.py']] == [None]
+    assert [summary for _, summary in results['file_2.py']] == ['summary of b']
+
+
+def test_failed_requests_stop_the_build():
+    summarizer = CodeSummarizer(FakeLlm(), 'python', max_concurrency=2)
+    with pytest.raises(RuntimeError) as error:
+        list(summarizer.summarize(file_snippets('a', 'unavailable', 'b')))
+    assert isinstance(error.value.__cause__, ConnectionError)
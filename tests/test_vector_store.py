@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from model import vector_store
+from model.vector_store import Segment
+
+FILES = 2000
+SNIPPETS_PER_FILE = 10
+DIM = 32
+
+
+@pytest.fixture
+def ivf_segment(tmp_path, monkeypatch):
+    # large enough for hundreds of ivf lists, of which only nprobe are visited per search
+    monkeypatch.setattr(vector_store, 'VECTORSTORE', str(tmp_path))
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((FILES * SNIPPETS_PER_FILE, DIM)).astype(np.float32)
+    metadatas = [{'file_name': f'file_{idx // SNIPPETS_PER_FILE}.py'} for idx in range(len(vectors))]
+    segment = Segment.create(DIM)
+    segment.add_embeddings([f'snippet {idx}' for idx in range(len(vectors))], vectors, metadatas)
+    segment.save('project', index_type='ivf')
+    return Segment.load('project', segment.segment_id), rng
+
+
+def query(rng):
+    return vector_store.normalize(rng.standard_normal((1, DIM)))
+
+
+def test_file_search_on_ivf_returns_k(ivf_segment):
+    segment, rng = ivf_segment
+    live_files = {file_name: segment.segment_id for file_name in segment.files}
+    file_names = {f'file_{idx}.py' for idx in range(0, FILES, FILES // 5)}
+    results = segment.search(query(rng), 20, live_files, file_names)
+    assert len(results) == 20
+    assert {doc.metadata['file_name'] for _, doc, _ in results} <= file_names
+    scores = [score for _, _, score in results]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_search_on_ivf_with_dead_files_returns_k(ivf_segment):
+    segment, rng = ivf_segment
+    live = {f'file_{idx}.py' for idx in range(0, FILES, FILES // 10)}
+    live_files = {file_name: segment.segment_id for file_name in live}
+    results = segment.search(query(rng), 20, live_files)
+    assert len(results) == 20
+    assert {doc.metadata['file_name'] for _, doc, _ in results} <= live
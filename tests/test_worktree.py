@@ -0,0 +1,40 @@
+import os
+
+from conftest import git, write_files
+from task import run_task
+from task.run_task import LLMCodeGenerator, index_commit
+from task.worktree_pool import WorktreePool
+from test_run_task import fake_embeddings
+
+
+def test_update_from_sha_in_pooled_worktree(storage, python_repo, monkeypatch):
+    fake_embeddings(monkeypatch)
+    project_path = os.path.dirname(python_repo)
+    first = index_commit('python', 'proj', project_path, 'master', content='code', parse_workers=1)
+    write_files(python_repo, {'pkg/module_1.py': 'def changed(value):\n    return value * 2\n',
+                              'pkg/added.py': 'def added():\n    return 0\n'})
+    git(python_repo, 'mv', 'pkg/module_2.py', 'pkg/renamed.py')
+    git(python_repo, 'rm', '-q', 'pkg/module_3.py')
+    git(python_repo, 'add', '.')
+    git(python_repo, 'commit', '-q', '-m', 'second')
+    second = git(python_repo, 'rev-parse', 'HEAD')
+    # the clone stays at the first commit, only the worktree has the files of the second
+    git(python_repo, 'checkout', '-q', '--detach', first)
+
+    pool = WorktreePool(python_repo, size=1, root=str(storage / 'worktrees'))
+    try:
+        with pool.lease(second) as work_path:
+            generator = LLMCodeGenerator('python', 'proj', project_path, 'instruction', sha=second,
+                                         work_path=work_path)
+            generator.set_vector_store(update_from_sha=first, content='code', parse_workers=1)
+            store = generator.vector_store
+            expected = {os.path.join(python_repo, 'pkg', f'module_{idx}.py') for idx in range(40) if idx not in (2, 3)}
+            expected |= {os.path.join(python_repo, 'pkg', name) for name in ('renamed.py', 'added.py')}
+            assert set(store.files) == expected
+            contents = {doc.metadata['file_name']: doc.page_content for segment in store.all_segments()
+                        for doc in segment.documents()
+                        if store.files.get(doc.metadata['file_name']) == segment.segment_id}
+            assert 'return value * 2' in contents[os.path.join(python_repo, 'pkg', 'module_1.py')]
+            assert 'def added' in contents[os.path.join(python_repo, 'pkg', 'added.py')]
+    finally:
+        pool.remove()
@@ -1,168 +1,441 @@
 import ast
+import io
 import re
-import astor
 
+# part of the snippet cache key, bump it whenever the snippets a parser returns change
+PARSER_VERSION = 4
 
-class CodeParser:
-    def sort_code(self, file_path):
-        pass
 
+def decode_source(data):
+    # same text as reading the file with open(), which decodes utf-8 and translates newlines
+    return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
 
-class DartParser(CodeParser):
-    def parse_comments(self, file_path):
+
+class CodeParser:
+    def read_source(self, file_path, content=None):
+        # content is given when the file is read from the git object database instead of the working tree
+        if content is not None:
+            return content
         with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
+            return file.read()
 
-        # search for single and multiple lines comments
-        comment_pattern = re.compile(
-            r'//.*?$|/\*.*?\*/', re.DOTALL | re.MULTILINE
-        )
+    def sort_code(self, file_path, content=None):
+        pass
 
-        matches = comment_pattern.finditer(content)
+    def line_range(self, content, position):
+        # zero based, end exclusive line range of a snippet position returned by sort_code
+        pass
 
-        comments_with_positions = []
-        for match in matches:
-            comment = match.group(0)
-            start = match.start()
-            end = match.end()
-            comments_with_positions.append((comment, (start, end)))
 
-        return comments_with_positions
+# snippets larger than this are split at member boundaries, estimated from characters
+MAX_SNIPPET_TOKENS = 1024
+CHARS_PER_TOKEN = 4
+# top level statements that never form a snippet of their own
+DART_DIRECTIVES = ('import', 'export', 'part', 'library', 'typedef')
+IDENTIFIER_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_$')
+DART_TOKEN = re.compile(r"(?P<space>\s+)|(?P<comment>//[^\n]*)|(?P<block>/\*)|(?P<raw>[rR](?=['\"]))|(?P<quote>['\"])"
+                        r"|(?P<identifier>[A-Za-z_$][\w$]*)|(?P<number>\d[\w$]*)|(?P<symbol>=>|==|!=|<=|>=|.)", re.S)
+# next character that can end a string literal or start an interpolation or escape
+DART_STRING_STOP = {quote: re.compile(r"[\\$\n" + quote + "]") for quote in '\'"'}
+DART_RAW_STRING_STOP = {quote: re.compile(r"[\n" + quote + "]") for quote in '\'"'}
+# characters that open or close braces, comments or strings inside a body
+DART_BRACES_STOP = re.compile(r"[{}/'\"]")
+
+
+def skip_dart_block_comment(content, i):
+    # block comments nest in dart
+    depth = 0
+    n = len(content)
+    while i < n:
+        if content.startswith('/*', i):
+            depth += 1
+            i += 2
+        elif content.startswith('*/', i):
+            depth -= 1
+            i += 2
+            if depth == 0:
+                return i
+        else:
+            i += 1
+    return n
+
+
+def skip_dart_string(content, i, raw=False):
+    # i is at the opening quote, returns the end of the literal including its interpolations
+    n = len(content)
+    quote = content[i]
+    delimiter = quote * 3 if content.startswith(quote * 3, i) else quote
+    stop = (DART_RAW_STRING_STOP if raw else DART_STRING_STOP)[quote]
+    i += len(delimiter)
+    while True:
+        match = stop.search(content, i)
+        if match is None:
+            return n
+        i = match.start()
+        c = content[i]
+        if c == '\\':
+            i += 2
+        elif content.startswith(delimiter, i):
+            return i + len(delimiter)
+        elif c == '\n':
+            if len(delimiter) == 1:
+                # unterminated single line string
+                return i
+            i += 1
+        elif c == '$' and content.startswith('{', i + 1):
+            i = skip_dart_braces(content, i + 2)
+        else:
+            i += 1
+
+
+def skip_dart_braces(content, i):
+    # i is after an opening '{' or '${', returns the position after the matching '}'
+    n = len(content)
+    depth = 0
+    while True:
+        match = DART_BRACES_STOP.search(content, i)
+        if match is None:
+            return n
+        i = match.start()
+        c = content[i]
+        if c == '{':
+            depth += 1
+            i += 1
+        elif c == '}':
+            if depth == 0:
+                return i + 1
+            depth -= 1
+            i += 1
+        elif c == '/':
+            if content.startswith('//', i):
+                i = content.find('\n', i)
+                if i == -1:
+                    return n
+            elif content.startswith('/*', i):
+                i = skip_dart_block_comment(content, i)
+            else:
+                i += 1
+        else:
+            raw = i > 0 and content[i - 1] in 'rR' and (i == 1 or content[i - 2] not in IDENTIFIER_CHARS)
+            i = skip_dart_string(content, i, raw=raw)
+
+
+def dart_tokens(content):
+    # single pass tokenizer, yields (kind, start, end) with kind one of 'comment', 'string', 'identifier',
+    # 'number' and 'symbol'. string literals with their interpolations are one token.
+    # '=>' and comparisons are kept whole so a lone '=' always is an assignment
+    n = len(content)
+    i = 0
+    while i < n:
+        match = DART_TOKEN.match(content, i)
+        kind = match.lastgroup
+        if kind == 'space':
+            i = match.end()
+        elif kind == 'block':
+            end = skip_dart_block_comment(content, i)
+            yield 'comment', i, end
+            i = end
+        elif kind == 'quote':
+            end = skip_dart_string(content, i)
+            yield 'string', i, end
+            i = end
+        elif kind == 'raw':
+            end = skip_dart_string(content, i + 1, raw=True)
+            yield 'string', i, end
+            i = end
+        else:
+            yield kind, i, match.end()
+            i = match.end()
+
+
+def dart_statement_declaration(head, has_body, arrow):
+    # classify a top level statement from the identifiers before its body or parameter list
+    for idx, word in enumerate(head):
+        following = head[idx + 1] if idx + 1 < len(head) else ''
+        if word in DART_DIRECTIVES:
+            return None
+        if word == 'class' or word == 'enum':
+            return word, following
+        if word == 'mixin' and following != 'class':
+            return 'mixin', following
+        if word == 'extension':
+            if following == 'type':
+                return 'extension', head[idx + 2] if idx + 2 < len(head) else ''
+            return 'extension', '' if following == 'on' else following
+    if (has_body or arrow) and head:
+        return 'function', head[-1]
+    return None
+
+
+def dart_statements(content, i=0, end=None):
+    # statements directly inside content[i:end] in one pass, as (start, end, head, has_body, arrow, body_start).
+    # a statement starts at its doc comment or annotations and ends with its body or its ';', bodies are
+    # skipped by brace matching without tokenizing them. body_start is the position after the body '{'
+    end = len(content) if end is None else end
+    nesting = 0  # parentheses, brackets and braces inside them
+    start = None
+    head = []
+    head_done = False
+    expression = False
+    arrow = False
+    annotation = False
+    # depth of the type arguments in the head, identifiers inside them are not part of the head
+    type_arguments = 0
+
+    while i < end:
+        match = DART_TOKEN.match(content, i, end)
+        kind = match.lastgroup
+        token_start, i = i, match.end()
+        if kind == 'space':
+            continue
+        if kind == 'comment' or kind == 'block':
+            if kind == 'block':
+                i = skip_dart_block_comment(content, token_start)
+            if start is None and content.startswith(('///', '/**'), token_start):
+                start = token_start
+            continue
+        if start is None:
+            start = token_start
+        if kind == 'quote' or kind == 'raw':
+            i = skip_dart_string(content, i - 1 if kind == 'quote' else i, raw=kind == 'raw')
+            annotation = False
+            continue
+        text = match.group()
+        if nesting > 0:
+            if text in ('(', '[', '{'):
+                nesting += 1
+            elif text in (')', ']', '}'):
+                nesting -= 1
+            continue
+        if kind == 'identifier':
+            if annotation is True:
+                annotation = 'name'
+            elif not head_done:
+                annotation = False
+                if not type_arguments:
+                    head.append(text)
+            continue
+        if text == '.' and annotation == 'name':
+            annotation = True
+            continue
+        annotation = False
+        if not head_done and text == '<':
+            type_arguments += 1
+            continue
+        if not head_done and type_arguments and text in ('>', '>='):
+            type_arguments -= 1
+            if text == '>':
+                continue
+            text = '='
+        if text == '@':
+            annotation = True
+        elif text in ('(', '['):
+            # the parameter list ends the head of a function
+            if text == '(' and head:
+                head_done = True
+            nesting += 1
+        elif text == '{':
+            body_start = i
+            i = skip_dart_braces(content, i)
+            if expression:
+                head_done = True
+            else:
+                yield start, i, head, True, arrow, body_start
+                start, head, head_done, expression, arrow, type_arguments = None, [], False, False, False, 0
+        elif text == '=':
+            expression = True
+            head_done = True
+        elif text == '=>':
+            arrow = not expression
+            expression = True
+            head_done = True
+        elif text == ';':
+            yield start, i, head, False, arrow, None
+            start, head, head_done, expression, arrow, type_arguments = None, [], False, False, False, 0
+
+
+def dart_declarations(content):
+    # top level class, mixin, extension, enum and function declarations as (kind, name, start, end, body_start)
+    declarations = []
+    for start, end, head, has_body, arrow, body_start in dart_statements(content):
+        declaration = dart_statement_declaration(head, has_body, arrow) if has_body or arrow else None
+        if declaration:
+            declarations.append((declaration[0], declaration[1], start, end, body_start))
+    return declarations
+
+
+def split_lines(content, start, end):
+    # cut content[start:end] at line ends into pieces of at most MAX_SNIPPET_TOKENS, lines longer than that are
+    # cut inside the line
+    pieces = []
+    max_chars = MAX_SNIPPET_TOKENS * CHARS_PER_TOKEN - 1
+    while end - start > max_chars:
+        cut = content.rfind('\n', start, start + max_chars) + 1
+        if cut <= start:
+            cut = start + max_chars
+        pieces.append((start, cut))
+        start = cut
+    pieces.append((start, end))
+    return pieces
+
+
+def chunk_span(span, members, size, split):
+    # split a declaration larger than MAX_SNIPPET_TOKENS at its member boundaries into bounded pieces.
+    # spans are end exclusive, the code between two members goes with the following one, members that are
+    # too large on their own are cut by split, and small neighbours are merged greedily
+    start, end = span
+    units = []
+    last = start
+    for member_start, member_end in members:
+        units.append((last, member_end))
+        last = member_end
+    if last < end:
+        units.append((last, end))
+    pieces = []
+    for unit in units:
+        for unit_start, unit_end in (split(*unit) if size(*unit) > MAX_SNIPPET_TOKENS else [unit]):
+            if pieces and size(pieces[-1][0], unit_end) <= MAX_SNIPPET_TOKENS:
+                pieces[-1] = (pieces[-1][0], unit_end)
+            else:
+                pieces.append((unit_start, unit_end))
+    return pieces
 
-    def parse_classes(self, file_path):
-        # comments
-        comments_with_positions = self.parse_comments(file_path)
 
-        with open(file_path, 'r', encoding='utf-8') as file:
-            content = file.read()
+class DartParser(CodeParser):
+    def parse_comments(self, file_path, content=None):
+        content = self.read_source(file_path, content)
+
+        return [(content[start:end], (start, end)) for kind, start, end in dart_tokens(content) if kind == 'comment']
 
-        # search for abstract class, class and mixin
-        class_pattern = re.compile(
-            r'\b(abstract\s+class|class|mixin)\s+([_\w]+)\s*(?:extends\s+[_\w<>]+\s*)?(?:implements\s+[_\w<>,\s]+\s*)?'
-            r'(?:with\s+[_\w<>,\s]+\s*)?\s*{',
-            re.MULTILINE
-        )
+    def parse_classes(self, file_path, content=None):
+        content = self.read_source(file_path, content)
 
-        matches = class_pattern.finditer(content)
+        # class, mixin, extension, enum and top level function spans, comments and strings can not fake braces.
+        # oversized ones are split at their members, or the statements of a function body, keeping their name
+        def size(start, end):
+            return (end - start) // CHARS_PER_TOKEN + 1
+
+        def split(start, end):
+            return split_lines(content, start, end)
 
         classes_with_code = []
         class_ranges = []
-        for match in matches:
-            class_keyword, class_name = match.group(1), match.group(2)
-            start = match.start()
-            brace_count = 0
-            end = start
-
-            for i in range(start, len(content)):
-                if content[i] == '{':
-                    brace_count += 1
-                elif content[i] == '}':
-                    brace_count -= 1
-                    if brace_count == 0:
-                        end = i + 1
-                        break
-
-            # check if class is inside comment
-            flag = True
-            for comment, position in comments_with_positions:
-                if position[0] <= start and position[1] >= end:
-                    flag = False
-                    break
-            if flag:
-                class_code = content[start:end].strip()
-                classes_with_code.append((class_name, class_code, (start, end)))
-                class_ranges.append((start, end))
-
-        # extract non class code
+        for kind, name, start, end, body_start in dart_declarations(content):
+            if size(start, end) <= MAX_SNIPPET_TOKENS:
+                pieces = [(start, end)]
+            else:
+                members = [statement[:2] for statement in dart_statements(content, body_start, end - 1)] \
+                    if body_start else []
+                pieces = chunk_span((start, end), members, size, split)
+            for piece_start, piece_end in pieces:
+                classes_with_code.append((name, content[piece_start:piece_end].strip(), (piece_start, piece_end)))
+            class_ranges.append((start, end))
+
+        # extract non class code, top level variables and directives between the declarations are bounded too
         non_class_with_code = []
         last_end = 0
-        for start, end in class_ranges:
+        for start, end in class_ranges + [(len(content), None)]:
             if last_end < start:
-                non_class_code = content[last_end:start].strip()
-                if non_class_code:
-                    non_class_with_code.append(('', non_class_code, (last_end, start)))
+                for piece_start, piece_end in split_lines(content, last_end, start):
+                    non_class_code = content[piece_start:piece_end].strip()
+                    if non_class_code:
+                        non_class_with_code.append(('', non_class_code, (piece_start, piece_end)))
             last_end = end
-        if last_end < len(content):
-            non_class_code = content[last_end:].strip()
-            if non_class_code:
-                non_class_with_code.append(('', non_class_code, (last_end, len(content))))
 
         return classes_with_code, non_class_with_code
 
-    def sort_code(self, file_path):
-        classes_with_code, non_class_with_code = self.parse_classes(file_path)
+    def sort_code(self, file_path, content=None):
+        classes_with_code, non_class_with_code = self.parse_classes(file_path, content)
         code = classes_with_code + non_class_with_code
         code.sort(key=lambda x: x[-1][0])
         return code
 
+    def line_range(self, content, position):
+        # positions are character offsets
+        start, end = position
+        return content.count('\n', 0, start), content.count('\n', 0, max(start, end - 1)) + 1
+
 
 class PythonParser(CodeParser):
-    def parse_classes(self, file_path):
-        with open(file_path, 'r') as file:
-            content = file.readlines()
-            code = ''.join(content)
-            tree = ast.parse(code, filename=file_path)
+    def parse_classes(self, file_path, content=None):
+        # lines end at '\n' only, like readlines, so positions match the lines of the file
+        content = io.StringIO(self.read_source(file_path, content)).readlines()
+        # top level classes and functions are sliced from the source with their decorators, methods stay
+        # inside their class so no code is emitted twice. positions are one based lines with an inclusive end
+        # oversized ones are split at the statements of their body, chunks work on zero based end exclusive lines
+        offsets = [0]
+        for line in content:
+            offsets.append(offsets[-1] + len(line))
+
+        def size(start, end):
+            return (offsets[end] - offsets[start]) // CHARS_PER_TOKEN + 1
+
+        def split(start, end):
+            pieces = []
+            piece_start = start
+            for line in range(start + 1, end):
+                if size(piece_start, line + 1) > MAX_SNIPPET_TOKENS:
+                    pieces.append((piece_start, line))
+                    piece_start = line
+            pieces.append((piece_start, end))
+            return pieces
+
+        def snippets(name, start, end):
+            # bounded snippets of the lines start to end, a single line longer than a snippet is cut inside the
+            # line and its pieces share its position
+            for piece_start, piece_end in split(start, end) if size(start, end) > MAX_SNIPPET_TOKENS \
+                    else [(start, end)]:
+                code = ''.join(content[piece_start:piece_end])
+                for cut_start, cut_end in split_lines(code, 0, len(code)):
+                    yield name, code[cut_start:cut_end], (piece_start + 1, piece_end)
+
+        try:
+            tree = ast.parse(''.join(content), filename=file_path)
+        except (SyntaxError, ValueError):
+            # files that do not parse are cut at line ends
+            return [], list(snippets('', 0, len(content))) if content else []
 
         classes_with_code = []
         class_ranges = []
-
-        class CodeSegmentVisitor(ast.NodeVisitor):
-            def __init__(self):
-                self.current_class = None
-                self.code = code
-
-            def visit_ClassDef(self, node: ast.ClassDef):
-                self.current_class = node.name
-                self._process_node(node)
-                self.generic_visit(node)
-
-            def visit_FunctionDef(self, node: ast.FunctionDef):
-                self._process_node(node)
-                self.generic_visit(node)
-
-            def visit_AsyncFunctionDef(self, node: ast.AsyncFunctionDef):
-                self._process_node(node)
-                self.generic_visit(node)
-
-            def _process_node(self, node: ast.AST):
-                if hasattr(node, 'lineno'):
-                    start_lineno = node.lineno
-                    end_lineno = getattr(node, 'end_lineno', start_lineno)
-                    segment_code = astor.to_source(node).strip()
-                    classes_with_code.append(('' if not self.current_class else self.current_class, segment_code,
-                                              (start_lineno, end_lineno)))
-                    class_ranges.append((start_lineno, end_lineno))
-
-            def _get_code_lines(self, start_lineno, end_lineno):
-                lines = self.code.splitlines(True)
-                if start_lineno > len(lines):
-                    return ''
-                return ''.join(lines[start_lineno - 1:end_lineno])
-
-        visitor = CodeSegmentVisitor()
-        visitor.visit(tree)
-
+        for node in tree.body:
+            if isinstance(node, (ast.ClassDef, ast.FunctionDef, ast.AsyncFunctionDef)):
+                start_lineno = self.start_lineno(node)
+                end_lineno = node.end_lineno
+                if size(start_lineno - 1, end_lineno) <= MAX_SNIPPET_TOKENS:
+                    pieces = [(start_lineno - 1, end_lineno)]
+                else:
+                    members = [(self.start_lineno(child) - 1, child.end_lineno) for child in node.body]
+                    pieces = chunk_span((start_lineno - 1, end_lineno), members, size, split)
+                for piece_start, piece_end in pieces:
+                    classes_with_code.extend(snippets(node.name, piece_start, piece_end))
+                class_ranges.append((start_lineno, end_lineno))
+
+        # module level statements between the definitions, bounded like the definitions
         non_class_with_code = []
         last_end = 0
-        for start, end in class_ranges:
-            if last_end < start:
-                non_class_code = ''.join(content[last_end:start])
-                if non_class_code:
-                    non_class_with_code.append(('', non_class_code, (last_end, start)))
+        for start, end in class_ranges + [(len(content) + 1, None)]:
+            if last_end < start - 1:
+                non_class_with_code.extend(snippet for snippet in snippets('', last_end, start - 1)
+                                           if snippet[1].strip())
             last_end = end
-        if last_end < len(content):
-            non_class_code = ''.join(content[last_end:])
-            if non_class_code:
-                non_class_with_code.append(('', non_class_code, (last_end, len(content))))
 
         return classes_with_code, non_class_with_code
 
-    def sort_code(self, file_name):
-        classes_with_code, non_class_with_code = self.parse_classes(file_name)
+    def start_lineno(self, node):
+        # decorators belong to the definition
+        return min([node.lineno] + [decorator.lineno for decorator in getattr(node, 'decorator_list', [])])
+
+    def sort_code(self, file_name, content=None):
+        classes_with_code, non_class_with_code = self.parse_classes(file_name, content)
         code = classes_with_code + non_class_with_code
         code.sort(key=lambda x: x[-1][0])
         return code
 
+    def line_range(self, content, position):
+        # positions are one based line numbers with an inclusive end
+        start, end = position
+        return max(0, start - 1), end
+
 
 def get_code_parser(language):
     if language.lower() == "python":
@@ -171,3 +444,10 @@ def get_code_parser(language):
         return DartParser()
     else:
         raise ValueError(f"Unsupported language {language}.")
+
+
+def parse_code_files(language, file_names, contents=None):
+    # entry point of parsing worker processes, contents of files read from git are passed along
+    code_parser = get_code_parser(language)
+    contents = contents or [None] * len(file_names)
+    return [code_parser.sort_code(file_name, content) for file_name, content in zip(file_names, contents)]
@@ -0,0 +1,47 @@
+import subprocess
+import threading
+
+
+class GitObjectReader:
+    # reads objects of a repository through one long running `git cat-file --batch` process,
+    # so files of any commit are read without checking it out
+    def __init__(self, repo_path):
+        self.repo_path = repo_path
+        self.lock = threading.Lock()
+        self.process = None
+
+    def start(self):
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(["git", "cat-file", "--batch"], cwd=self.repo_path,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        return self.process
+
+    def read(self, object_name):
+        # contents of a blob sha or of a '<commit>:<path>' name, None when the object does not exist
+        with self.lock:
+            process = self.start()
+            process.stdin.write(object_name.encode('utf-8') + b'\n')
+            process.stdin.flush()
+            header = process.stdout.readline().decode('utf-8').split()
+            if len(header) != 3:
+                # '<name> missing' or '<name> ambiguous'
+                return None
+            size = int(header[2])
+            data = process.stdout.read(size)
+            # every object is followed by a newline
+            process.stdout.read(1)
+            return data
+
+    def close(self):
+        with self.lock:
+            if self.process is not None:
+                self.process.stdin.close()
+                self.process.wait()
+                self.process.stdout.close()
+                self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
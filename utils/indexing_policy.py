@@ -0,0 +1,90 @@
+import hashlib
+import os
+import re
+from fnmatch import fnmatchcase
+
+# outputs of code generators, they are rebuilt from their sources and never edited by hand
+GENERATED_SUFFIXES = {"flutter": ('.g.dart', '.freezed.dart', '.mocks.dart', '.gr.dart', '.config.dart',
+                                  '.gen.dart', '.pb.dart', '.pbenum.dart', '.pbjson.dart', '.pbserver.dart',
+                                  '.pbgrpc.dart'),
+                      "python": ('_pb2.py', '_pb2_grpc.py')}
+# build output, l10n output and vendored packages, matched against the path relative to the project
+DEFAULT_EXCLUDE = {"flutter": ('**/.dart_tool/**', '**/build/**', '**/.pub-cache/**', '**/.symlinks/**',
+                               '**/ephemeral/**', '**/lib/generated/**', '**/lib/l10n/app_localizations*.dart'),
+                   "python": ('**/.venv/**', '**/venv/**', '**/site-packages/**', '**/node_modules/**',
+                              '**/build/**', '**/.tox/**')}
+# a comment in the head of a file that marks it as generated, like "// GENERATED CODE - DO NOT MODIFY BY HAND"
+GENERATED_HEADER = re.compile(r'^\s*(?://|#).*(?:GENERATED CODE|DO NOT EDIT|DO NOT MODIFY|@generated)', re.M)
+HEADER_BYTES = 1024
+
+
+def glob_match(path, pattern):
+    # '*' also matches '/', a leading '**/' matches at the project root as well
+    return fnmatchcase(path, pattern) or (pattern.startswith('**/') and fnmatchcase(path, pattern[3:]))
+
+
+def file_hash(file_name):
+    with open(file_name, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+class IndexingPolicy:
+    def __init__(self, language, project_path, include=None, exclude=None, skip_generated=True, read_head=None):
+        # include globs restrict indexing to the matching files, exclude globs are added to the defaults.
+        # read_head returns the first bytes of a file, files are read from the working tree by default
+        self.language = language
+        self.project_path = project_path
+        self.include = list(include or [])
+        self.exclude = list(DEFAULT_EXCLUDE.get(language, ())) + list(exclude or [])
+        self.skip_generated = skip_generated
+        self.read_head = read_head or self.read_file_head
+
+    def relative_path(self, file_name):
+        return os.path.relpath(file_name, self.project_path).replace(os.sep, '/')
+
+    @staticmethod
+    def read_file_head(file_name):
+        try:
+            with open(file_name, 'rb') as file:
+                return file.read(HEADER_BYTES)
+        except OSError:
+            return b''
+
+    def is_generated(self, file_name):
+        if file_name.endswith(GENERATED_SUFFIXES.get(self.language, ())):
+            return True
+        head = self.read_head(file_name)[:HEADER_BYTES].decode('utf-8', errors='ignore')
+        return GENERATED_HEADER.search(head) is not None
+
+    def excluded(self, file_name):
+        # reason a file is not indexed, None when it is
+        path = self.relative_path(file_name)
+        if self.include and not any(glob_match(path, pattern) for pattern in self.include):
+            return 'include'
+        if any(glob_match(path, pattern) for pattern in self.exclude):
+            return 'exclude'
+        if self.skip_generated and self.is_generated(file_name):
+            return 'generated'
+        return None
+
+    def select(self, file_names):
+        selected, skipped = [], {}
+        for file_name in file_names:
+            reason = self.excluded(file_name)
+            if reason is None:
+                selected.append(file_name)
+            else:
+                skipped[reason] = skipped.get(reason, 0) + 1
+        if skipped:
+            print(f"Indexing {len(selected)} of {len(file_names)} code files, skipped:",
+                  ', '.join(f'{count} {reason}' for reason, count in skipped.items()))
+        return selected
+
+    @staticmethod
+    def group_duplicates(file_names, content_key):
+        # content key -> files with that content, in input order. the first file is parsed and summarized,
+        # its snippets are linked to the others
+        groups = {}
+        for file_name in file_names:
+            groups.setdefault(content_key(file_name), []).append(file_name)
+        return groups